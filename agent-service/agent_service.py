@@ -1,25 +1,51 @@
 # agent_service.py
 import os
+import io
+import csv
 import json
-import psycopg2
-from flask import Flask, request, jsonify
+import hashlib
+from flask import Flask, Response, request, jsonify
+from common.bulk_copy import copy_with_ids
+from common.cache import TTLCache
+from common.db import ConnectionPool
+from common.streaming import STREAM_MIMETYPES, stream_rows
 
 app = Flask(__name__)
 
 # PostgreSQL connection parameters
-DB_HOST = "localhost"
-DB_NAME = "moon-agent"
-DB_USER = "admin"
-DB_PASS = "password"
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_NAME = os.environ.get("DB_NAME", "moon-agent")
+DB_USER = os.environ.get("DB_USER", "admin")
+DB_PASS = os.environ.get("DB_PASS", "password")
+DB_PORT = int(os.environ.get("DB_PORT", 5432))
+
+db_pool = ConnectionPool.from_env(
+    host=DB_HOST,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    port=DB_PORT
+)
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        DB_HOST = os.environ.get("DB_HOST", "localhost"),
-        DB_NAME = os.environ.get("DB_NAME", "moon-agent"),
-        DB_USER = os.environ.get("DB_USER", "admin"),
-        DB_PASS = os.environ.get("DB_PASS", "password"),
-    )
-    return conn
+    return db_pool.getconn()
+
+def agent_row_to_dict(agent):
+    # Parse products from text to list
+    products = json.loads(agent[4]) if agent[4] else []
+    return {
+        "id": agent[0],
+        "name": agent[1],
+        "code": agent[2],
+        "details": agent[3],
+        "products": products
+    }
+
+def normalize_products(products):
+    # Convert a comma separated string of product codes to a list
+    if isinstance(products, str):
+        products = [p.strip() for p in products.split(",")]
+    return products
 
 # CREATE
 @app.route('/agents', methods=['POST'])
@@ -31,10 +57,7 @@ def create_agent():
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Convert products to JSON string if it's a list or string
-        products = data.get("products", [])
-        if isinstance(products, str):
-            products = [p.strip() for p in products.split(",")]
+        products = normalize_products(data.get("products", []))
         products_str = json.dumps(products)
 
         cursor.execute(
@@ -51,14 +74,118 @@ def create_agent():
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# CREATE (Bulk)
+
+def parse_bulk_agents():
+    # Accepts a JSON array, NDJSON (one agent per line) or CSV with a header row
+    if request.mimetype == "text/csv":
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    if request.mimetype == "application/x-ndjson":
+        # A malformed line becomes its ValueError and is reported for that row
+        rows = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as e:
+                rows.append(e)
+        return rows
+    rows = request.get_json()
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of agents")
+    return rows
+
+@app.route('/agents/bulk', methods=['POST'])
+def create_agents_bulk():
+    conn = None
+    cursor = None
+    try:
+        rows = parse_bulk_agents()
+
+        results = []
+        valid = []
+        for index, data in enumerate(rows):
+            if isinstance(data, ValueError):
+                results.append({"row": index, "error": f"Invalid JSON: {data}"})
+                continue
+            if not isinstance(data, dict):
+                results.append({"row": index, "error": "Expected an object"})
+                continue
+            missing = [field for field in ("name", "code", "details") if data.get(field) is None]
+            if missing:
+                results.append({"row": index, "error": f"Missing required field: {missing[0]}"})
+                continue
+            # Same values the single-row insert accepts: a dict or list there
+            # fails to bind rather than being stored as its repr
+            invalid = [field for field in ("name", "code", "details")
+                       if isinstance(data[field], bool) or not isinstance(data[field], (str, int, float))]
+            if invalid:
+                results.append({"row": index, "error": f"Field {invalid[0]} must be a string or number"})
+                continue
+            products = normalize_products(data.get("products") or [])
+            result = {"row": index, "id": None}
+            results.append(result)
+            valid.append((result, data, products))
+
+        if valid:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+
+            # One COPY for the whole batch; rows the database rejects are
+            # reported individually and the rest are still inserted
+            inserted = copy_with_ids(
+                cursor, "agents", ("name", "code", "details", "products"),
+                [(data["name"], data["code"], data["details"], json.dumps(products)) for _, data, products in valid])
+            for (result, _, _), (new_id, error) in zip(valid, inserted):
+                if error:
+                    del result["id"]
+                    result["error"] = error
+                else:
+                    result["id"] = new_id
+            conn.commit()
+
+        inserted = sum(1 for result in results if "error" not in result)
+        return jsonify({
+            "inserted": inserted,
+            "failed": len(results) - inserted,
+            "results": results
+        }), 201 if inserted else 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
 
 # READ (Single)
+agent_cache = TTLCache(
+    maxsize=int(os.environ.get("AGENT_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("AGENT_CACHE_TTL", 60))
+)
+
+def agent_response(body, etag):
+    # The cached body is sent as-is; a matching If-None-Match skips it entirely
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
 @app.route('/agents/<int:agent_id>', methods=['GET'])
 def get_agent(agent_id):
+    cached = agent_cache.get(agent_id)
+    if cached is not None:
+        return agent_response(*cached)
+
     conn = None
     cursor = None
     try:
+        generation = agent_cache.generation()
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -68,56 +195,75 @@ def get_agent(agent_id):
         if agent is None:
             return jsonify({"error": "Agent not found"}), 404
         
-        # Parse products from text to list
-        products = json.loads(agent[4]) if agent[4] else []
-            
-        return jsonify({
-            "id": agent[0],
-            "name": agent[1],
-            "code": agent[2],
-            "details": agent[3],
-            "products": products
-        }), 200
+        body = app.json.dumps(agent_row_to_dict(agent))
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        agent_cache.set(agent_id, (body, etag), generation=generation)
+        return agent_response(body, etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     finally:
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 # READ (All)
+AGENTS_PAGE_DEFAULT = 100
+AGENTS_PAGE_MAX = 1000
+AGENTS_STREAM_BATCH = 1000
+
+def agents_product_filter(product):
+    # Matches idx_agents_products_gin (migrations/001_agents_products_gin.sql)
+    if product is None:
+        return "", ()
+    return " AND products::jsonb @> %s::jsonb", (json.dumps([product]),)
+
+def stream_agents(stream_format, product=None):
+    product_sql, product_params = agents_product_filter(product)
+    return stream_rows(
+        db_pool, "agents_stream",
+        "SELECT id, name, code, details, products FROM agents WHERE TRUE" + product_sql + " ORDER BY id",
+        product_params, agent_row_to_dict, stream_format, AGENTS_STREAM_BATCH)
+
 @app.route('/agents', methods=['GET'])
 def get_all_agents():
+    product = request.args.get("product")
+    stream_format = request.args.get("stream")
+    if stream_format is not None:
+        if stream_format not in STREAM_MIMETYPES:
+            return jsonify({"error": "stream must be 'ndjson' or 'json'"}), 400
+        return Response(stream_agents(stream_format, product), mimetype=STREAM_MIMETYPES[stream_format]), 200
+
     conn = None
     cursor = None
     try:
+        limit = int(request.args.get("limit", AGENTS_PAGE_DEFAULT))
+        after_id = int(request.args.get("after_id", 0))
+        if not 1 <= limit <= AGENTS_PAGE_MAX:
+            return jsonify({"error": f"limit must be between 1 and {AGENTS_PAGE_MAX}"}), 400
+
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute("SELECT id, name, code, details, products FROM agents")
-        agents = cursor.fetchall()
-        
-        agents_list = []
-        for agent in agents:
-            # Parse products from text to list
-            products = json.loads(agent[4]) if agent[4] else []
-            agents_list.append({
-                "id": agent[0],
-                "name": agent[1],
-                "code": agent[2],
-                "details": agent[3],
-                "products": products
-            })
-            
-        return jsonify(agents_list), 200
+
+        product_sql, product_params = agents_product_filter(product)
+        cursor.execute(
+            "SELECT id, name, code, details, products FROM agents WHERE id > %s" + product_sql +
+            " ORDER BY id LIMIT %s",
+            (after_id,) + product_params + (limit,))
+        agents_list = [agent_row_to_dict(agent) for agent in cursor.fetchall()]
+
+        response = jsonify(agents_list)
+        # A full page means there may be more; clients pass this back as after_id
+        if len(agents_list) == limit:
+            response.headers["X-Next-After-Id"] = str(agents_list[-1]["id"])
+        return response, 200
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     finally:
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 # UPDATE
 @app.route('/agents/<int:agent_id>', methods=['PUT'])
@@ -134,10 +280,7 @@ def update_agent(agent_id):
         if cursor.fetchone() is None:
             return jsonify({"error": "Agent not found"}), 404
 
-        # Convert products to JSON string if it's a list or string
-        products = data.get("products", [])
-        if isinstance(products, str):
-            products = [p.strip() for p in products.split(",")]
+        products = normalize_products(data.get("products", []))
         products_str = json.dumps(products)
 
         cursor.execute(
@@ -148,6 +291,7 @@ def update_agent(agent_id):
         )
         
         conn.commit()
+        agent_cache.invalidate(agent_id)
         return jsonify({
             "id": agent_id,
             "name": data["name"],
@@ -161,7 +305,7 @@ def update_agent(agent_id):
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 # DELETE
 @app.route('/agents/<int:agent_id>', methods=['DELETE'])
@@ -179,6 +323,7 @@ def delete_agent(agent_id):
 
         cursor.execute("DELETE FROM agents WHERE id = %s", (agent_id,))
         conn.commit()
+        agent_cache.invalidate(agent_id)
         
         return jsonify({"message": "Agent deleted successfully"}), 200
     except Exception as e:
@@ -187,7 +332,17 @@ def delete_agent(agent_id):
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# METRICS - Connection pool usage and wait times
+@app.route('/metrics/db-pool', methods=['GET'])
+def db_pool_metrics():
+    return jsonify(db_pool.stats()), 200
+
+# METRICS - Agent cache hit/miss counters
+@app.route('/metrics/agent-cache', methods=['GET'])
+def agent_cache_metrics():
+    return jsonify(agent_cache.stats()), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
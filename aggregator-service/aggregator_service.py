@@ -1,7 +1,18 @@
-import psycopg2
+import argparse
 import json
-from datetime import datetime
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
 import os
+import numpy as np
+from flask import Flask, Response, request, jsonify
+from common.cache import TTLCache
+from common.db import ConnectionPool
+from common.listener import listen
+from sales_analytics import SalesAnalytics
 
 # PostgreSQL connection
 DB_CONFIG = {
@@ -12,94 +23,473 @@ DB_CONFIG = {
     "port": 5432
 }
 
+db_pool = ConnectionPool.from_env(**DB_CONFIG)
+
 def get_db():
-    return psycopg2.connect(**DB_CONFIG)
+    return db_pool.getconn()
 
-def generate_daily_reports():
-    print("Generating daily reports...")
+ROLLUP_REFRESH_LOCK = 5001
+ROLLUPS_REFRESHED_CHANNEL = "sales_rollups_refreshed"
+
+def refresh_daily_rollups():
+    # Re-aggregate only the days logged in sales_rollup_dirty_days
+    # (migrations/005_sales_daily_rollups.sql) since the last refresh.
     conn = None
     try:
         conn = get_db()
         cur = conn.cursor()
 
-        # Best performing teams (top 10 agents)
-        cur.execute("""
-            SELECT a.id, a.name, SUM(s.sale_amount) as total_sales
-            FROM agents a
-            JOIN sales_data s ON a.id = s.agent_id
-            WHERE s.sale_date >= CURRENT_DATE - INTERVAL '30 days'
-            GROUP BY a.id
-            ORDER BY total_sales DESC
-            LIMIT 10
-        """)
-        top_performers = [{"agent_id": r[0], "name": r[1], "sales": float(r[2])} for r in cur.fetchall()]
-
-        # Product performance
+        # Serialise refreshes (cron, backfill, report API) so two cannot rebuild
+        # the same day at once
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_REFRESH_LOCK,))
+        cur.execute("DELETE FROM sales_rollup_dirty_days RETURNING day")
+        days = sorted({r[0] for r in cur.fetchall()})
+        if not days:
+            conn.commit()
+            return []
+
+        for table in ("sales_daily_agent", "sales_daily_product", "sales_daily_branch"):
+            cur.execute(f"DELETE FROM {table} WHERE day = ANY(%s)", (days,))
+
         cur.execute("""
-            SELECT product_code, COUNT(*), SUM(sale_amount)
-            FROM sales_data
-            WHERE sale_date >= CURRENT_DATE - INTERVAL '30 days'
-            GROUP BY product_code
-            ORDER BY SUM(sale_amount) DESC
-        """)
-        product_performance = [{
-            "product": r[0],
-            "transactions": r[1],
-            "revenue": float(r[2])
-        } for r in cur.fetchall()]
-
-        # Target achievements
+            INSERT INTO sales_daily_agent (day, agent_id, sale_count, total_sales)
+            SELECT d.day, s.agent_id, COUNT(*), SUM(s.sale_amount)
+            FROM unnest(%s::date[]) AS d(day)
+            JOIN sales_data s ON s.sale_date >= d.day AND s.sale_date < d.day + 1
+            GROUP BY d.day, s.agent_id
+        """, (days,))
+        # product_code is part of the key, so sales without one are kept
+        # under '' and read back as NULL
         cur.execute("""
-            SELECT a.id, a.name, SUM(s.sale_amount) as total_sales,
-                   np.sales_target_threshold as target,
-                   SUM(s.sale_amount) >= np.sales_target_threshold as achieved
-            FROM agents a
-            JOIN sales_data s ON a.id = s.agent_id
-            JOIN notification_preferences np ON a.id = np.agent_id
-            WHERE s.sale_date >= DATE_TRUNC('month', CURRENT_DATE)
-            GROUP BY a.id, np.sales_target_threshold
-        """)
-        target_achievements = [{
-            "agent_id": r[0], "name": r[1], "sales": float(r[2]),
-            "target": float(r[3]), "achieved": r[4]
-        } for r in cur.fetchall()]
-
-        # Branch Performance
+            INSERT INTO sales_daily_product (day, product_code, sale_count, total_sales)
+            SELECT d.day, COALESCE(s.product_code, ''), COUNT(*), SUM(s.sale_amount)
+            FROM unnest(%s::date[]) AS d(day)
+            JOIN sales_data s ON s.sale_date >= d.day AND s.sale_date < d.day + 1
+            GROUP BY d.day, COALESCE(s.product_code, '')
+        """, (days,))
         cur.execute("""
-            SELECT b.id, b.name, SUM(s.sale_amount) as total_sales
-            FROM branches b
-            JOIN agents a ON b.id = a.branch_id
-            JOIN sales_data s ON a.id = s.agent_id
-            WHERE s.sale_date >= DATE_TRUNC('month', CURRENT_DATE)
-            GROUP BY b.id
-            ORDER BY total_sales DESC
-        """)
-        branch_performance = [{
-            "branch_id": r[0], "name": r[1], "total_sales": float(r[2])
-        } for r in cur.fetchall()]
-
-        # Store report
-        report_date = datetime.now().date()
-        report_data = {
-            "top_performers": top_performers,
-            "product_performance": product_performance,
-            "target_achievements": target_achievements,
-            "branch_performance": branch_performance,
-            "generated_at": datetime.now().isoformat()
-        }
+            INSERT INTO sales_daily_branch (day, branch_id, sale_count, total_sales)
+            SELECT r.day, a.branch_id, SUM(r.sale_count), SUM(r.total_sales)
+            FROM sales_daily_agent r
+            JOIN agents a ON a.id = r.agent_id
+            WHERE r.day = ANY(%s) AND a.branch_id IS NOT NULL
+            GROUP BY r.day, a.branch_id
+        """, (days,))
 
-        cur.execute("""
-            INSERT INTO performance_reports (report_date, report_type, data)
-            VALUES (%s, %s, %s)
-        """, (report_date, "daily", json.dumps(report_data)))
+        # Delivered on commit; report API caches covering these days drop them
+        cur.execute("SELECT pg_notify(%s, %s)",
+                    (ROLLUPS_REFRESHED_CHANNEL, f"{days[0].isoformat()}:{days[-1].isoformat()}"))
+        conn.commit()
+        print(f"Refreshed daily rollups for {len(days)} day(s).")
+        return days
+    finally:
+        if conn:
+            db_pool.putconn(conn)
+
+def agent_sections(cur, report_date):
+    # One pass over the agent rollup for the widest window (last 30 days or
+    # month to date) feeds both the top performers and target achievements.
+    cur.execute("""
+        WITH agent_window AS MATERIALIZED (
+            SELECT agent_id,
+                   SUM(total_sales) FILTER (WHERE day >= %(day)s::date - 30) AS sales_30d,
+                   SUM(total_sales) FILTER (WHERE day >= DATE_TRUNC('month', %(day)s::date)) AS sales_mtd
+            FROM sales_daily_agent
+            WHERE day >= LEAST(%(day)s::date - 30, DATE_TRUNC('month', %(day)s::date)::date)
+              AND day <= %(day)s
+            GROUP BY agent_id
+        )
+        SELECT a.id, a.name, w.sales_30d, w.sales_mtd, np.sales_target_threshold
+        FROM agent_window w
+        JOIN agents a ON a.id = w.agent_id
+        LEFT JOIN notification_preferences np ON np.agent_id = a.id
+    """, {"day": report_date})
+    rows = cur.fetchall()
+
+    # Best performing teams (top 10 agents)
+    top = sorted((r for r in rows if r[2] is not None), key=lambda r: r[2], reverse=True)[:10]
+    top_performers = [{"agent_id": r[0], "name": r[1], "sales": float(r[2])} for r in top]
+
+    # Target achievements
+    target_achievements = [{
+        "agent_id": r[0], "name": r[1], "sales": float(r[3]),
+        "target": float(r[4]), "achieved": r[3] >= r[4]
+    } for r in rows if r[3] is not None and r[4] is not None]
+
+    return top_performers, target_achievements
+
+def product_section(cur, report_date):
+    # Product performance
+    cur.execute("""
+        SELECT NULLIF(product_code, ''), SUM(sale_count), SUM(total_sales)
+        FROM sales_daily_product
+        WHERE day >= %(day)s::date - 30 AND day <= %(day)s
+        GROUP BY product_code
+        ORDER BY SUM(total_sales) DESC
+    """, {"day": report_date})
+    return [{
+        "product": r[0],
+        "transactions": int(r[1]),
+        "revenue": float(r[2])
+    } for r in cur.fetchall()]
+
+def branch_section(cur, report_date):
+    # Branch Performance
+    cur.execute("""
+        SELECT b.id, b.name, SUM(r.total_sales) as total_sales
+        FROM branches b
+        JOIN sales_daily_branch r ON b.id = r.branch_id
+        WHERE r.day >= DATE_TRUNC('month', %(day)s::date) AND r.day <= %(day)s
+        GROUP BY b.id
+        ORDER BY total_sales DESC
+    """, {"day": report_date})
+    return [{
+        "branch_id": r[0], "name": r[1], "total_sales": float(r[2])
+    } for r in cur.fetchall()]
+
+ANALYTICS_WINDOW_DAYS = 30
+ANALYTICS_CHUNK_SIZE = int(os.getenv("ANALYTICS_CHUNK_SIZE", 50000))
 
+def analytics_section(cur, report_date):
+    # Percentiles, distributions, moving averages and day-over-day growth for
+    # the last 30 days, from one pass over sales_data. Rows arrive through a
+    # server-side cursor ANALYTICS_CHUNK_SIZE at a time and each chunk is
+    # folded into SalesAnalytics, so the window is never held in memory.
+    start_date = report_date - timedelta(days=ANALYTICS_WINDOW_DAYS)
+    analytics = SalesAnalytics(start_date, ANALYTICS_WINDOW_DAYS + 1)
+    stream = cur.connection.cursor(name="analytics_sales")
+    try:
+        stream.itersize = ANALYTICS_CHUNK_SIZE
+        stream.execute("""
+            SELECT agent_id, sale_date::date - %(start)s, sale_amount::float8
+            FROM sales_data
+            WHERE sale_date >= %(start)s AND sale_date < %(day)s::date + 1
+        """, {"start": start_date, "day": report_date})
+        while True:
+            rows = stream.fetchmany(ANALYTICS_CHUNK_SIZE)
+            if not rows:
+                break
+            columns = np.array(rows, dtype=np.float64)
+            analytics.add(columns[:, 0].astype(np.int64), columns[:, 1].astype(np.int64), columns[:, 2])
+    finally:
+        stream.close()
+    return analytics.result()
+
+def run_section(name, section, report_date):
+    # Each section runs on its own pooled connection so they can overlap
+    started = time.monotonic()
+    conn = get_db()
+    try:
+        result = section(conn.cursor(), report_date)
+    finally:
+        db_pool.putconn(conn)
+    print(f"  {name}: {time.monotonic() - started:.3f}s")
+    return result
+
+def build_report(report_date, parallel=True):
+    if parallel:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            agents = executor.submit(run_section, "agent sections", agent_sections, report_date)
+            products = executor.submit(run_section, "product performance", product_section, report_date)
+            branches = executor.submit(run_section, "branch performance", branch_section, report_date)
+            analytics = executor.submit(run_section, "sales analytics", analytics_section, report_date)
+            top_performers, target_achievements = agents.result()
+            product_performance = products.result()
+            branch_performance = branches.result()
+            sales_analytics = analytics.result()
+    else:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            top_performers, target_achievements = agent_sections(cur, report_date)
+            product_performance = product_section(cur, report_date)
+            branch_performance = branch_section(cur, report_date)
+            sales_analytics = analytics_section(cur, report_date)
+        finally:
+            db_pool.putconn(conn)
+
+    return {
+        "top_performers": top_performers,
+        "product_performance": product_performance,
+        "target_achievements": target_achievements,
+        "branch_performance": branch_performance,
+        "sales_analytics": sales_analytics,
+        "generated_at": datetime.now().isoformat()
+    }
+
+def store_report(cur, report_date, report_data):
+    # Upsert on uq_performance_reports_date_type (migrations/006_performance_reports_upsert.sql)
+    cur.execute("""
+        INSERT INTO performance_reports (report_date, report_type, data)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (report_date, report_type)
+        DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+    """, (report_date, "daily", json.dumps(report_data)))
+
+def generate_daily_reports():
+    print("Generating daily reports...")
+    conn = None
+    try:
+        started = time.monotonic()
+        refresh_daily_rollups()
+        print(f"  rollup refresh: {time.monotonic() - started:.3f}s")
+
+        report_date = datetime.now().date()
+        report_data = build_report(report_date)
+
+        conn = get_db()
+        cur = conn.cursor()
+        store_report(cur, report_date, report_data)
         conn.commit()
-        print("✅ Daily reports generated successfully.")
+        print(f"✅ Daily reports generated successfully in {time.monotonic() - started:.3f}s.")
     except Exception as e:
         print(f"❌ Error generating reports: {str(e)}")
     finally:
         if conn:
-            conn.close()
+            db_pool.putconn(conn)
+
+def backfill_day(run_id, report_date):
+    report_data = build_report(report_date, parallel=False)
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        store_report(cur, report_date, report_data)
+        cur.execute(
+            "INSERT INTO report_backfill_progress (run_id, report_date) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (run_id, report_date))
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
+
+def backfill_reports(start_date, end_date, workers=4, run_id=None):
+    # Rebuilds the daily report for every day in [start_date, end_date]. Each
+    # run gets a fresh run_id unless one is passed; days already completed by
+    # that run_id are skipped, so passing the id of an interrupted run resumes
+    # it. A run that completes clears its progress, so rebuilding the same
+    # range again (after a fix or a new metric) needs no new id.
+    # Concurrent connections are bounded by the pool (DB_POOL_MAX).
+    run_id = run_id or uuid.uuid4().hex[:12]
+    print(f"Backfilling daily reports {start_date} to {end_date} (run {run_id})...")
+    started = time.monotonic()
+    refresh_daily_rollups()
+
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT report_date FROM report_backfill_progress WHERE run_id = %s", (run_id,))
+        completed = {r[0] for r in cur.fetchall()}
+    finally:
+        db_pool.putconn(conn)
+
+    days = [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+    pending = [day for day in days if day not in completed]
+    print(f"  {len(days) - len(pending)} day(s) already done, {len(pending)} to build")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=min(workers, db_pool.maxconn)) as executor:
+        futures = {executor.submit(backfill_day, run_id, day): day for day in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"❌ {futures[future]}: {str(e)}")
+
+    print(f"✅ Backfilled {len(pending) - len(failed)} day(s) in {time.monotonic() - started:.3f}s.")
+    if failed:
+        print(f"❌ {len(failed)} day(s) failed; re-run with --run-id {run_id} to retry them.")
+        return False
+
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM report_backfill_progress WHERE run_id = %s", (run_id,))
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
+    return True
+
+# On-demand report API (python aggregator_service.py serve)
+app = Flask(__name__)
+
+REPORT_DEFAULT_DAYS = 7
+REPORT_TOP_AGENTS = 10
+REPORT_REFRESH_INTERVAL = float(os.getenv("REPORT_REFRESH_INTERVAL", 10))
+report_cache = TTLCache(
+    maxsize=int(os.getenv("REPORT_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("REPORT_CACHE_TTL", 300))
+)
+
+def report_params(args):
+    # Normalised so equivalent requests share one cache entry
+    end = date.fromisoformat(args["to"]) if args.get("to") else datetime.now().date()
+    if args.get("from"):
+        start = date.fromisoformat(args["from"])
+    else:
+        start = end - timedelta(days=int(args.get("days", REPORT_DEFAULT_DAYS)) - 1)
+    if start > end:
+        raise ValueError("from must not be after to")
+    return {
+        "from": start,
+        "to": end,
+        "branch_id": int(args["branch_id"]) if args.get("branch_id") else None,
+        "agent_id": int(args["agent_id"]) if args.get("agent_id") else None,
+        "product_code": args.get("product_code", "").strip() or None,
+    }
+
+def build_window_report(cur, params):
+    # Without a product filter everything comes from the per-day rollups;
+    # a product filter needs the raw sales (idx_sales_data_agent_product_date
+    # covers the agent + product case).
+    if params["product_code"] is None:
+        source = "rollup"
+        facts = """
+            SELECT day, agent_id, sale_count, total_sales
+            FROM sales_daily_agent
+            WHERE day >= %(from)s AND day <= %(to)s"""
+    else:
+        source = "sales_data"
+        facts = """
+            SELECT sale_date::date AS day, agent_id, 1 AS sale_count, sale_amount AS total_sales
+            FROM sales_data
+            WHERE sale_date >= %(from)s AND sale_date < %(to)s::date + 1
+              AND product_code = %(product_code)s"""
+    if params["agent_id"] is not None:
+        facts += " AND agent_id = %(agent_id)s"
+    branch_filter = " WHERE a.branch_id = %(branch_id)s" if params["branch_id"] is not None else ""
+
+    # Daily totals, per-agent and per-branch breakdowns in a single scan
+    cur.execute(f"""
+        WITH facts AS MATERIALIZED ({facts})
+        SELECT GROUPING(f.day), GROUPING(a.id), f.day, a.id, a.name, a.branch_id,
+               SUM(f.sale_count), SUM(f.total_sales)
+        FROM facts f
+        JOIN agents a ON a.id = f.agent_id{branch_filter}
+        GROUP BY GROUPING SETS ((f.day), (a.id, a.name), (a.branch_id))
+    """, params)
+
+    daily, agents, branches = [], [], []
+    for day_grouped, agent_grouped, day, agent_id, name, branch_id, count, total in cur.fetchall():
+        if not day_grouped:
+            daily.append({"day": day.isoformat(), "sale_count": int(count), "total_sales": float(total)})
+        elif not agent_grouped:
+            agents.append({"agent_id": agent_id, "name": name, "sale_count": int(count), "total_sales": float(total)})
+        elif branch_id is not None:
+            branches.append({"branch_id": branch_id, "sale_count": int(count), "total_sales": float(total)})
+    daily.sort(key=lambda d: d["day"])
+    agents.sort(key=lambda a: a["total_sales"], reverse=True)
+    branches.sort(key=lambda b: b["total_sales"], reverse=True)
+
+    # Product breakdown
+    if params["product_code"] is not None:
+        products = [{
+            "product": params["product_code"],
+            "transactions": sum(d["sale_count"] for d in daily),
+            "revenue": sum(d["total_sales"] for d in daily)
+        }] if daily else []
+    else:
+        if params["agent_id"] is None and params["branch_id"] is None:
+            cur.execute("""
+                SELECT NULLIF(product_code, ''), SUM(sale_count), SUM(total_sales)
+                FROM sales_daily_product
+                WHERE day >= %(from)s AND day <= %(to)s
+                GROUP BY product_code
+                ORDER BY SUM(total_sales) DESC
+            """, params)
+        else:
+            source = "rollup+sales_data"
+            cur.execute(f"""
+                SELECT s.product_code, COUNT(*), SUM(s.sale_amount)
+                FROM sales_data s
+                JOIN agents a ON a.id = s.agent_id
+                WHERE s.sale_date >= %(from)s AND s.sale_date < %(to)s::date + 1
+                  {"AND s.agent_id = %(agent_id)s" if params["agent_id"] is not None else ""}
+                  {"AND a.branch_id = %(branch_id)s" if params["branch_id"] is not None else ""}
+                GROUP BY s.product_code
+                ORDER BY SUM(s.sale_amount) DESC
+            """, params)
+        products = [{"product": r[0], "transactions": int(r[1]), "revenue": float(r[2])} for r in cur.fetchall()]
+
+    return {
+        "window": {"from": params["from"].isoformat(), "to": params["to"].isoformat()},
+        "filters": {k: params[k] for k in ("branch_id", "agent_id", "product_code")},
+        "totals": {
+            "sale_count": sum(d["sale_count"] for d in daily),
+            "total_sales": sum(d["total_sales"] for d in daily)
+        },
+        "daily": daily,
+        "top_agents": agents[:REPORT_TOP_AGENTS],
+        "branch_performance": branches,
+        "product_performance": products,
+        "source": source,
+        "generated_at": datetime.now().isoformat()
+    }
+
+@app.route('/reports', methods=['GET'])
+def get_report():
+    try:
+        params = report_params(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    key = (params["from"], params["to"], params["branch_id"], params["agent_id"], params["product_code"])
+    body = report_cache.get(key)
+    if body is None:
+        generation = report_cache.generation()
+        conn = None
+        try:
+            conn = get_db()
+            body = app.json.dumps(build_window_report(conn.cursor(), params))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        finally:
+            if conn:
+                db_pool.putconn(conn)
+        report_cache.set(key, body, generation=generation)
+    return Response(body, mimetype="application/json"), 200
+
+@app.route('/metrics/report-cache', methods=['GET'])
+def report_cache_metrics():
+    return jsonify(report_cache.stats()), 200
+
+def invalidate_reports(first_day, last_day):
+    report_cache.invalidate_where(lambda key: key[0] <= last_day and first_day <= key[1])
+
+def rollups_refreshed(payload):
+    first, _, last = payload.partition(":")
+    invalidate_reports(date.fromisoformat(first), date.fromisoformat(last))
+
+def watch_rollups():
+    # Keeps rollups current while serving, and drops cached reports whose
+    # window overlaps days refreshed by any process (cron, backfill, replicas).
+    listen(db_pool, ROLLUPS_REFRESHED_CHANNEL, threading.Event(), rollups_refreshed,
+           on_idle=refresh_daily_rollups, on_error=report_cache.clear, description="Rollup watcher",
+           poll_interval=REPORT_REFRESH_INTERVAL, retry_interval=REPORT_REFRESH_INTERVAL)
+
+def serve():
+    threading.Thread(target=watch_rollups, name="rollup-watcher", daemon=True).start()
+    app.run(host='0.0.0.0', port=int(os.getenv("PORT", 8081)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate moon-agent performance reports")
+    subparsers = parser.add_subparsers(dest="command")
+    backfill = subparsers.add_parser("backfill", help="rebuild daily reports for a date range")
+    backfill.add_argument("--from", dest="start_date", required=True, type=date.fromisoformat)
+    backfill.add_argument("--to", dest="end_date", required=True, type=date.fromisoformat)
+    backfill.add_argument("--workers", type=int, default=4)
+    backfill.add_argument("--run-id")
+    subparsers.add_parser("serve", help="serve on-demand reports over HTTP")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        if args.end_date < args.start_date:
+            parser.error("--to must not be before --from")
+        if not backfill_reports(args.start_date, args.end_date, args.workers, args.run_id):
+            sys.exit(1)
+    elif args.command == "serve":
+        serve()
+    else:
+        generate_daily_reports()
 
 if __name__ == "__main__":
-    generate_daily_reports()
+    main()
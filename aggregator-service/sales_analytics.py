@@ -0,0 +1,160 @@
+# sales_analytics.py
+# Vectorized metrics over a window of sales, fed in fixed-size chunks.
+#
+# Each chunk is reduced straight away into per-day totals, per-(agent, day)
+# totals and a fine log-scale histogram of sale amounts, so memory grows with
+# the number of agents and days in the window, never with the number of
+# sales. Sale-amount percentiles are read off the histogram; bins are 1% wide,
+# which bounds their relative error to about 1%.
+from datetime import timedelta
+
+import numpy as np
+
+HISTOGRAM_MIN = 0.01
+HISTOGRAM_MAX = 1e7
+HISTOGRAM_BINS_PER_DECADE = 230   # 10 ** (1 / 230) ~ 1.01
+
+PERCENTILES = (50, 75, 90, 95, 99)
+MOVING_AVERAGE_DAYS = (7, 30)
+TOP_AGENTS = 10
+
+
+class SalesAnalytics:
+    def __init__(self, start_date, days):
+        self.start_date = start_date
+        self.days = days
+        decades = np.log10(HISTOGRAM_MAX / HISTOGRAM_MIN)
+        self._edges = HISTOGRAM_MIN * np.logspace(0, decades, int(decades * HISTOGRAM_BINS_PER_DECADE) + 1)
+        # Bin 0 holds amounts below HISTOGRAM_MIN, the last bin those above HISTOGRAM_MAX
+        self._histogram = np.zeros(len(self._edges) + 1, dtype=np.int64)
+        self._day_sales = np.zeros(days)
+        self._day_counts = np.zeros(days, dtype=np.int64)
+        self._agent_day_keys = np.empty(0, dtype=np.int64)
+        self._agent_day_sales = np.empty(0)
+        self._pending = []
+        self._pending_size = 0
+        self._count = 0
+        self._sum = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+
+    def add(self, agent_ids, day_offsets, amounts):
+        # agent_ids and day_offsets are integer arrays, day_offsets counted from
+        # start_date; amounts is a float array of the same length.
+        if not len(amounts):
+            return
+        self._count += len(amounts)
+        self._sum += float(amounts.sum())
+        self._min = min(self._min, float(amounts.min()))
+        self._max = max(self._max, float(amounts.max()))
+        self._histogram += np.bincount(np.searchsorted(self._edges, amounts, side="right"),
+                                       minlength=len(self._histogram))
+        self._day_sales += np.bincount(day_offsets, weights=amounts, minlength=self.days)
+        self._day_counts += np.bincount(day_offsets, minlength=self.days)
+
+        # Group the chunk by (agent, day); partial groups are merged into the
+        # running totals once they outgrow them, which keeps merging amortised
+        keys, inverse = np.unique(agent_ids * self.days + day_offsets, return_inverse=True)
+        self._pending.append((keys, np.bincount(inverse, weights=amounts)))
+        self._pending_size += len(keys)
+        if self._pending_size >= max(len(self._agent_day_keys), 1 << 16):
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self._agent_day_keys] + [k for k, _ in self._pending])
+        sales = np.concatenate([self._agent_day_sales] + [v for _, v in self._pending])
+        self._agent_day_keys, inverse = np.unique(keys, return_inverse=True)
+        self._agent_day_sales = np.bincount(inverse, weights=sales)
+        self._pending = []
+        self._pending_size = 0
+
+    def _percentiles(self):
+        if not self._count:
+            return {}
+        cumulative = np.cumsum(self._histogram)
+        result = {}
+        for p in PERCENTILES:
+            rank = p / 100 * (self._count - 1)
+            bin_no = int(np.searchsorted(cumulative, rank, side="right"))
+            if bin_no == 0:
+                value = self._min
+            elif bin_no == len(self._edges):
+                value = self._max
+            else:
+                # Geometric midpoint of the bin, clamped to the observed range
+                value = float(np.sqrt(self._edges[bin_no - 1] * self._edges[bin_no]))
+            result[f"p{p}"] = round(min(max(value, self._min), self._max), 2)
+        return result
+
+    def _distribution(self):
+        # Collapse the fine histogram into one bucket per decade
+        buckets = []
+        per_decade = HISTOGRAM_BINS_PER_DECADE
+        counts = self._histogram
+        if counts[0]:
+            buckets.append({"from": None, "to": HISTOGRAM_MIN, "count": int(counts[0])})
+        for start in range(1, len(self._edges), per_decade):
+            count = int(counts[start:start + per_decade].sum())
+            if count:
+                end = min(start + per_decade - 1, len(self._edges) - 1)
+                buckets.append({"from": round(float(self._edges[start - 1]), 2),
+                                "to": round(float(self._edges[end]), 2), "count": count})
+        if counts[-1]:
+            buckets.append({"from": HISTOGRAM_MAX, "to": None, "count": int(counts[-1])})
+        return buckets
+
+    def _daily(self):
+        previous = np.concatenate([[np.nan], self._day_sales[:-1]])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            growth = np.where(previous > 0, (self._day_sales - previous) / previous * 100, np.nan)
+        return [{
+            "day": (self.start_date + timedelta(days=i)).isoformat(),
+            "sales": round(float(self._day_sales[i]), 2),
+            "transactions": int(self._day_counts[i]),
+            "growth_pct": None if np.isnan(growth[i]) else round(float(growth[i]), 2)
+        } for i in range(self.days)]
+
+    def _agents(self):
+        self._merge()
+        agents, columns = np.divmod(self._agent_day_keys, self.days)
+        agent_ids, rows = np.unique(agents, return_inverse=True)
+        if not len(agent_ids):
+            return {"agents": 0, "moving_averages": [], "total_percentiles": {}}
+
+        totals = np.bincount(rows, weights=self._agent_day_sales, minlength=len(agent_ids))
+        averages = {}
+        for n in MOVING_AVERAGE_DAYS:
+            if n <= self.days:
+                recent = columns >= self.days - n
+                averages[n] = np.bincount(rows[recent], weights=self._agent_day_sales[recent],
+                                          minlength=len(agent_ids)) / n
+        top = np.argsort(totals, kind="stable")[::-1][:TOP_AGENTS]
+        return {
+            "agents": int(len(agent_ids)),
+            "moving_averages": [dict(
+                {"agent_id": int(agent_ids[i]), "total": round(float(totals[i]), 2)},
+                **{f"ma_{n}d": round(float(averages[n][i]), 2) for n in averages}
+            ) for i in top],
+            "total_percentiles": {
+                f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(totals, PERCENTILES))
+            },
+        }
+
+    def result(self):
+        return {
+            "window_start": self.start_date.isoformat(),
+            "window_days": self.days,
+            "sales": {
+                "count": self._count,
+                "total": round(self._sum, 2),
+                "mean": round(self._sum / self._count, 2) if self._count else None,
+                "min": round(self._min, 2) if self._count else None,
+                "max": round(self._max, 2) if self._count else None,
+                "percentiles": self._percentiles(),
+                "distribution": self._distribution(),
+            },
+            "daily": self._daily(),
+            "agents": self._agents(),
+        }
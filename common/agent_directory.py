@@ -0,0 +1,146 @@
+# agent_directory.py
+# In-memory set of existing agent ids, so hot paths can skip
+# `SELECT id FROM agents WHERE id = %s`.
+#
+# Agent ids are dense serial integers, so membership is a plain bitmap:
+# exact, and ~125 KB per million ids. The directory is loaded at start and
+# kept current from the agents_changed channel
+# (migrations/003_agents_changed_notify.sql), with a periodic full reload as
+# a fallback. An id missing from the bitmap is confirmed against the database
+# before being rejected, so a new agent is never refused; a recently deleted
+# one may be accepted briefly, which the foreign keys still catch.
+import threading
+import time
+
+from common.listener import listen
+
+
+class IdBitmap:
+    def __init__(self, ids=()):
+        self._bits = bytearray()
+        self._count = 0
+        for agent_id in ids:
+            self.add(agent_id)
+
+    def add(self, agent_id):
+        byte, bit = divmod(agent_id, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte - len(self._bits) + 1))
+        if not self._bits[byte] & (1 << bit):
+            self._bits[byte] |= 1 << bit
+            self._count += 1
+
+    def discard(self, agent_id):
+        byte, bit = divmod(agent_id, 8)
+        if byte < len(self._bits) and self._bits[byte] & (1 << bit):
+            self._bits[byte] &= ~(1 << bit) & 0xFF
+            self._count -= 1
+
+    def __contains__(self, agent_id):
+        byte, bit = divmod(agent_id, 8)
+        return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << bit))
+
+    def __len__(self):
+        return self._count
+
+    def nbytes(self):
+        return len(self._bits)
+
+
+class AgentDirectory:
+    def __init__(self, pool, reload_interval=300, channel="agents_changed"):
+        self.pool = pool
+        self.reload_interval = reload_interval
+        self.channel = channel
+        self._ids = IdBitmap()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._last_reload = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"hits": 0, "misses": 0, "confirmed": 0, "reloads": 0, "notifications": 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="agent-directory", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def reload(self):
+        conn = self.pool.getconn()
+        cursor = None
+        try:
+            cursor = conn.cursor(name="agent_directory_reload")
+            cursor.itersize = 10000
+            cursor.execute("SELECT id FROM agents")
+            ids = IdBitmap(row[0] for row in cursor)
+        finally:
+            if cursor is not None:
+                cursor.close()
+            self.pool.putconn(conn)
+        with self._lock:
+            self._ids = ids
+            self._loaded = True
+            self._last_reload = time.monotonic()
+            self._stats["reloads"] += 1
+
+    def _apply(self, payload):
+        op, _, agent_id = payload.partition(":")
+        with self._lock:
+            self._stats["notifications"] += 1
+            if op == "I":
+                self._ids.add(int(agent_id))
+            elif op == "D":
+                self._ids.discard(int(agent_id))
+
+    def _reload_if_stale(self):
+        if time.monotonic() - self._last_reload >= self.reload_interval:
+            self.reload()
+
+    def _run(self):
+        listen(self.pool, self.channel, self._stop, self._apply, on_connect=self.reload,
+               on_idle=self._reload_if_stale, description="Agent directory listener")
+
+    def exists(self, cursor, agent_id):
+        return bool(self.existing(cursor, [agent_id]))
+
+    def existing(self, cursor, agent_ids):
+        # Returns the subset of agent_ids that exist, querying only for ids the
+        # directory does not know about.
+        found = set()
+        unknown = []
+        for agent_id in agent_ids:
+            try:
+                agent_id = int(agent_id)
+            except (TypeError, ValueError):
+                continue
+            if self._loaded and agent_id in self._ids:
+                found.add(agent_id)
+            else:
+                unknown.append(agent_id)
+
+        with self._lock:
+            self._stats["hits"] += len(found)
+            self._stats["misses"] += len(unknown)
+        if unknown:
+            cursor.execute("SELECT id FROM agents WHERE id = ANY(%s)", (unknown,))
+            confirmed = [row[0] for row in cursor.fetchall()]
+            with self._lock:
+                for agent_id in confirmed:
+                    self._ids.add(agent_id)
+                self._stats["confirmed"] += len(confirmed)
+            found.update(confirmed)
+        return found
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "loaded": self._loaded,
+                "agents": len(self._ids),
+                "bitmap_bytes": self._ids.nbytes(),
+                "seconds_since_reload": time.monotonic() - self._last_reload if self._loaded else None,
+            })
+            return stats
@@ -0,0 +1,68 @@
+# bulk_copy.py
+# Bulk inserts into a table with a serial id column.
+#
+# Ids are reserved from the table's sequence up front, so every row's id is
+# known without relying on RETURNING order, and all rows are loaded with a
+# single COPY. If the COPY is rejected (a duplicate, an over-long value, a
+# NOT NULL violation) the rows are inserted one at a time under savepoints
+# instead, so the good rows still go in and each bad row gets its own error.
+import io
+
+import psycopg2
+
+
+def copy_text_value(value):
+    # COPY text format: \N is NULL, so '' and NULL stay distinct
+    if value is None:
+        return "\\N"
+    if isinstance(value, (dict, list, tuple, set)):
+        # str() would store the Python repr; callers serialize JSON themselves
+        raise TypeError(f"can't copy a {type(value).__name__} value")
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def reserve_ids(cursor, table, count):
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                   (table, count))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def copy_with_ids(cursor, table, columns, rows):
+    # rows are sequences of values for columns. Returns one (id, error) pair
+    # per row: the new id and None, or None and the database's message. The
+    # caller commits.
+    if not rows:
+        return []
+    ids = reserve_ids(cursor, table, len(rows))
+    buffer = io.StringIO()
+    for row_id, row in zip(ids, rows):
+        buffer.write("\t".join(copy_text_value(value) for value in (row_id, *row)) + "\n")
+    buffer.seek(0)
+
+    column_list = ", ".join(("id",) + tuple(columns))
+    cursor.execute("SAVEPOINT bulk_copy")
+    try:
+        cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", buffer)
+        cursor.execute("RELEASE SAVEPOINT bulk_copy")
+        return [(row_id, None) for row_id in ids]
+    except psycopg2.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy")
+
+    results = []
+    insert = f"INSERT INTO {table} ({column_list}) VALUES ({', '.join(['%s'] * (len(columns) + 1))})"
+    for row_id, row in zip(ids, rows):
+        cursor.execute("SAVEPOINT bulk_copy_row")
+        try:
+            cursor.execute(insert, (row_id, *row))
+            cursor.execute("RELEASE SAVEPOINT bulk_copy_row")
+            results.append((row_id, None))
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy_row")
+            results.append((None, e.diag.message_primary or str(e).strip()))
+        except ValueError as e:
+            # Rejected by psycopg2 before it reached the server (a NUL byte)
+            cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy_row")
+            results.append((None, str(e)))
+    cursor.execute("RELEASE SAVEPOINT bulk_copy")
+    return results
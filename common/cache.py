@@ -0,0 +1,78 @@
+# cache.py
+# Thread-safe in-process LRU cache with a per-entry time to live.
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value), least recently used first
+        self._generation = 0            # bumped on every invalidation
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def generation(self):
+        # Read before loading a value from the source; passing it back to set()
+        # drops the fill if an invalidation raced with the load.
+        with self._lock:
+            return self._generation
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+            self._stats["misses"] += 1
+            return default
+
+    def set(self, key, value, ttl=None, generation=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, _MISSING) is not _MISSING:
+                self._stats["invalidations"] += 1
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            self._generation += 1
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats.update({
+                "size": len(self._entries),
+                "max_size": self.maxsize,
+                "ttl": self.ttl,
+                "hit_ratio": stats["hits"] / lookups if lookups else 0.0,
+            })
+            return stats
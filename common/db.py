@@ -0,0 +1,224 @@
+# db.py
+# Shared, thread-safe PostgreSQL connection pool used by every moon-agent service.
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, minconn=1, maxconn=10, max_lifetime=1800, timeout=30,
+                 ping_interval=30, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: minconn=%s maxconn=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = deque()        # (conn, returned_at), most recently returned on the right
+        self._born = {}             # id(conn) -> created_at
+        self._size = 0              # open connections, idle + checked out
+        self._filled = False
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "health_check_failures": 0,
+        }
+
+    @classmethod
+    def from_env(cls, prefix="DB_POOL_", **connect_kwargs):
+        return cls(
+            minconn=int(os.environ.get(prefix + "MIN", 1)),
+            maxconn=int(os.environ.get(prefix + "MAX", 10)),
+            max_lifetime=float(os.environ.get(prefix + "MAX_LIFETIME", 1800)),
+            timeout=float(os.environ.get(prefix + "TIMEOUT", 30)),
+            ping_interval=float(os.environ.get(prefix + "PING_INTERVAL", 30)),
+            **connect_kwargs
+        )
+
+    def connect_unpooled(self):
+        # A connection with the pool's settings that the caller owns, for
+        # long-lived uses such as LISTEN that would otherwise pin a pool slot.
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _connect(self):
+        conn = self.connect_unpooled()
+        with self._cond:
+            self._born[id(conn)] = time.monotonic()
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _expired(self, conn):
+        born = self._born.get(id(conn))
+        return born is not None and self.max_lifetime and time.monotonic() - born >= self.max_lifetime
+
+    def _discard(self, conn):
+        # Caller must hold self._cond
+        self._born.pop(id(conn), None)
+        self._size -= 1
+        self._stats["connections_discarded"] += 1
+        self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed or self._expired(conn):
+            return False
+        if time.monotonic() - returned_at < self.ping_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            return False
+
+    def _fill(self):
+        # Open the minimum number of connections the first time the pool is used
+        # rather than at import time, so services can start before the database.
+        conns = []
+        try:
+            for _ in range(self.minconn):
+                with self._cond:
+                    if self._size >= self.minconn:
+                        break
+                    self._size += 1
+                try:
+                    conns.append(self._connect())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                    raise
+        finally:
+            with self._cond:
+                now = time.monotonic()
+                self._idle.extend((conn, now) for conn in conns)
+                self._cond.notify_all()
+
+    def getconn(self, timeout=None):
+        if not self._filled:
+            # Only marked filled once it succeeds, so a failed fill (database
+            # still starting) is retried on the next checkout. Concurrent
+            # fills stop at minconn.
+            self._fill()
+            self._filled = True
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        conn = None
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout("timed out after %.1fs waiting for a database connection" % timeout)
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                self._cond.wait(remaining)
+
+        if conn is not None and not self._healthy(conn, returned_at):
+            # Keep the slot and replace the stale connection below
+            with self._cond:
+                self._discard(conn)
+                self._size += 1
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        with self._cond:
+            wait = time.monotonic() - started
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += wait
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                close = True
+
+        with self._cond:
+            if close or conn.closed or self._closed or self._expired(conn):
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "wait_time_avg": stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0,
+            })
+            return stats
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
@@ -0,0 +1,38 @@
+# listener.py
+# Follows a NOTIFY channel on a dedicated connection, reconnecting after any
+# failure. on_connect runs after every (re)connect to load the state the
+# notifications keep current, on_idle when nothing arrived for poll_interval
+# seconds, and on_error after a failure, before waiting to reconnect.
+import logging
+import select
+
+logger = logging.getLogger(__name__)
+
+
+def listen(pool, channel, stop, on_payload, on_connect=None, on_idle=None, on_error=None,
+           description="Listener", poll_interval=5, retry_interval=5):
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = pool.connect_unpooled()
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN " + channel)
+            # Subscribe before loading so no change can fall between the two
+            if on_connect is not None:
+                on_connect()
+            while not stop.is_set():
+                if select.select([conn], [], [], poll_interval) == ([], [], []):
+                    if on_idle is not None:
+                        on_idle()
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    on_payload(conn.notifies.pop(0).payload)
+        except Exception:
+            logger.exception("%s failed; reconnecting", description)
+            if on_error is not None:
+                on_error()
+            stop.wait(retry_interval)
+        finally:
+            if conn is not None:
+                conn.close()
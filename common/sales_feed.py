@@ -0,0 +1,89 @@
+# sales_feed.py
+# Follows the sales_deltas channel (migrations/007_sales_deltas_notify.sql)
+# and hands every per-(agent, day) change in sales totals to subscribers.
+#
+# A subscriber implements rebuild(cursor), which reloads its state from
+# sales_data, and apply(agent_id, day, amount, count). Rebuilds run after
+# every (re)connect inside one REPEATABLE READ transaction; notifications
+# from transactions already visible to that snapshot are skipped, so no
+# change is counted twice or missed.
+import threading
+from datetime import date
+from decimal import Decimal
+
+from common.listener import listen
+
+
+def parse_snapshot(snapshot):
+    xmin, xmax, xip = snapshot.split(":")
+    return int(xmin), int(xmax), {int(x) for x in xip.split(",") if x}
+
+
+def visible_in_snapshot(xid, snapshot):
+    xmin, xmax, xip = snapshot
+    if xid < xmin:
+        return True
+    if xid >= xmax:
+        return False
+    return xid not in xip
+
+
+class SalesFeed:
+    def __init__(self, pool, channel="sales_deltas"):
+        self.pool = pool
+        self.channel = channel
+        self.subscribers = []
+        self.ready = threading.Event()
+        self._snapshot = None
+        self._stop = threading.Event()
+        self._stats = {"rebuilds": 0, "notifications": 0, "skipped": 0, "deltas": 0}
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def start(self):
+        threading.Thread(target=self._run, name="sales-feed", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def rebuild(self):
+        conn = self.pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cursor.execute("SELECT txid_current_snapshot()::text")
+            snapshot = parse_snapshot(cursor.fetchone()[0])
+            for subscriber in self.subscribers:
+                subscriber.rebuild(cursor)
+            cursor.close()
+        finally:
+            self.pool.putconn(conn)
+        self._snapshot = snapshot
+        self._stats["rebuilds"] += 1
+        self.ready.set()
+
+    def _dispatch(self, payload):
+        self._stats["notifications"] += 1
+        # The header is "<txid>:<sequence number>"; the number only keeps
+        # payloads distinct
+        header, _, body = payload.partition("\n")
+        xid = int(header.partition(":")[0])
+        if visible_in_snapshot(xid, self._snapshot):
+            self._stats["skipped"] += 1
+            return
+        for line in body.splitlines():
+            agent_id, day, amount, count = line.split(",")
+            agent_id, day, amount, count = int(agent_id), date.fromisoformat(day), Decimal(amount), int(count)
+            self._stats["deltas"] += 1
+            for subscriber in self.subscribers:
+                subscriber.apply(agent_id, day, amount, count)
+
+    def _run(self):
+        listen(self.pool, self.channel, self._stop, self._dispatch, on_connect=self.rebuild,
+               on_error=self.ready.clear, description="Sales feed listener")
+
+    def stats(self):
+        return dict(self._stats, ready=self.ready.is_set())
@@ -0,0 +1,34 @@
+# streaming.py
+# Streams a query's rows into an HTTP response as NDJSON or a JSON array.
+# Rows come from a server-side cursor in batches of batch_size, so memory
+# stays flat however large the result is.
+import json
+
+STREAM_MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def stream_rows(pool, name, query, params, row_to_dict, stream_format, batch_size=1000):
+    conn = pool.getconn()
+    cursor = None
+    try:
+        cursor = conn.cursor(name=name)
+        cursor.itersize = batch_size
+        cursor.execute(query, params)
+
+        if stream_format == "ndjson":
+            for row in cursor:
+                yield json.dumps(row_to_dict(row)) + "\n"
+        else:
+            yield "["
+            separator = ""
+            for row in cursor:
+                yield separator + json.dumps(row_to_dict(row))
+                separator = ","
+            yield "]"
+    finally:
+        if cursor is not None:
+            cursor.close()
+        pool.putconn(conn)
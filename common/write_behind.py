@@ -0,0 +1,179 @@
+# write_behind.py
+# Durable append-only log drained to the database in micro-batches.
+#
+# append() returns once the record is fsynced to a local segment file.
+# Concurrent appends share one fsync (group commit). A background thread
+# rotates the active segment when batch_size records are pending or every
+# interval seconds, passes the closed segments to the flush callback and
+# deletes them once it returns. Segments left behind by a crash are replayed
+# on start, so the flush callback must be idempotent.
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindLog:
+    def __init__(self, log_dir, flush, batch_size=500, interval=0.5, name="records"):
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.name = name
+        self._flush = flush
+
+        self._lock = threading.Lock()        # guards the active segment
+        self._sync_lock = threading.Lock()   # serialises fsync and rotation
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._written = 0
+        self._synced = 0
+        self._pending = 0
+        self._stats = {
+            "appended": 0,
+            "fsyncs": 0,
+            "flushed": 0,
+            "flush_batches": 0,
+            "flush_errors": 0,
+            "replayed_segments": 0,
+        }
+
+    def _segment_path(self, number):
+        return os.path.join(self.log_dir, "%s-%012d.log" % (self.name, number))
+
+    def _segments(self):
+        prefix = self.name + "-"
+        return sorted(
+            os.path.join(self.log_dir, f) for f in os.listdir(self.log_dir)
+            if f.startswith(prefix) and f.endswith(".log")
+        )
+
+    def _open_segment(self):
+        self._segment_no += 1
+        self._file = open(self._segment_path(self._segment_no), "ab")
+
+    def start(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        # Only one process may own a log directory
+        self._dir_lock = open(os.path.join(self.log_dir, self.name + ".lock"), "w")
+        try:
+            fcntl.flock(self._dir_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise RuntimeError("write-behind log %s is in use by another process" % self.log_dir)
+
+        leftover = self._segments()
+        self._stats["replayed_segments"] = len(leftover)
+        if leftover:
+            logger.info("Replaying %d unflushed %s segment(s)", len(leftover), self.name)
+        self._segment_no = int(leftover[-1].rsplit("-", 1)[1][:-4]) if leftover else 0
+        self._open_segment()
+
+        self._thread = threading.Thread(target=self._run, name="write-behind-" + self.name, daemon=True)
+        self._thread.start()
+        self._wake.set()
+        return self
+
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._written += 1
+            seq = self._written
+            self._pending += 1
+            self._stats["appended"] += 1
+            if self._pending >= self.batch_size:
+                self._wake.set()
+        self._sync(seq)
+
+    def _sync(self, seq):
+        with self._sync_lock:
+            if self._synced >= seq:
+                # Another thread's fsync already covered this record
+                return
+            with self._lock:
+                target = self._written
+                fd = self._file.fileno()
+            os.fsync(fd)
+            self._synced = target
+            self._stats["fsyncs"] += 1
+
+    def _rotate(self):
+        with self._sync_lock, self._lock:
+            if not self._pending:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._synced = self._written
+            self._pending = 0
+            self._open_segment()
+
+    def _read_segment(self, path):
+        records = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn final write from a crash; it was never acknowledged
+                    logger.warning("Skipping unreadable record in %s", path)
+        return records
+
+    def flush(self):
+        with self._flush_lock:
+            self._rotate()
+            with self._lock:
+                active = self._file.name
+            for path in self._segments():
+                if path == active:
+                    continue
+                records = self._read_segment(path)
+                for start in range(0, len(records), self.batch_size):
+                    batch = records[start:start + self.batch_size]
+                    self._flush(batch)
+                    with self._lock:
+                        self._stats["flushed"] += len(batch)
+                        self._stats["flush_batches"] += 1
+                os.remove(path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Segments stay on disk and are retried on the next tick
+                with self._lock:
+                    self._stats["flush_errors"] += 1
+                logger.exception("Failed to flush %s; will retry", self.name)
+                time.sleep(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._file.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "pending": self._pending,
+                "segments": len(self._segments()),
+                "batch_size": self.batch_size,
+                "interval": self.interval,
+            })
+            return stats
@@ -1,25 +1,53 @@
 # integration_service.py
-from flask import Flask, request, jsonify
-import psycopg2
+from flask import Flask, Response, request, jsonify
+import atexit
+import heapq
 import json
+import math
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import date, datetime, timedelta
+from operator import itemgetter
+import psycopg2
+from psycopg2.extras import execute_values
+from common.agent_directory import AgentDirectory
+from common.bulk_copy import copy_with_ids
+from common.db import ConnectionPool
+from common.sales_feed import SalesFeed
+from common.streaming import STREAM_MIMETYPES, stream_rows
+from common.write_behind import WriteBehindLog
 
 app = Flask(__name__)
 
 # PostgreSQL connection parameters
-DB_HOST = "localhost"
-DB_NAME = "moon-agent"
-DB_USER = "admin"
-DB_PASS = "password"
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_NAME = os.environ.get("DB_NAME", "moon-agent")
+DB_USER = os.environ.get("DB_USER", "admin")
+DB_PASS = os.environ.get("DB_PASS", "password")
+DB_PORT = int(os.environ.get("DB_PORT", 5432))
+
+db_pool = ConnectionPool.from_env(
+    host=DB_HOST,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    port=DB_PORT
+)
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        port=5432
-    )
-    return conn
+    return db_pool.getconn()
+
+agent_directory = AgentDirectory(
+    db_pool, reload_interval=float(os.environ.get("AGENT_DIRECTORY_RELOAD_INTERVAL", 300))
+).start()
+
+SALE_REQUIRED_FIELDS = ['agent_id', 'sale_amount', 'product_code', 'sale_date']
+# sales_data.product_code is VARCHAR(64), here and in the warehouse
+PRODUCT_CODE_MAX_LENGTH = 64
+# sales_data.sale_amount is NUMERIC(12, 2)
+SALE_AMOUNT_LIMIT = 10 ** 10
 
 # CREATE - Receive sales data
 @app.route('/sales-data', methods=['POST'])
@@ -28,21 +56,51 @@ def receive_sales():
     cursor = None
     try:
         data = request.get_json()
-        required_fields = ['agent_id', 'sale_amount', 'product_code', 'sale_date']
         
         # Validate required fields
-        for field in required_fields:
+        for field in SALE_REQUIRED_FIELDS:
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
 
+        if sales_log is not None:
+            # Rows are only written later, so bad values must be caught now
+            error = validate_sale(data)
+            if error:
+                return jsonify({"error": error}), 400
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Check if agent exists
-        cursor.execute("SELECT id FROM agents WHERE id = %s", (data['agent_id'],))
-        if cursor.fetchone() is None:
+        # Check if agent exists. A buffered sale cannot be refused once it is
+        # acknowledged, so ask the database rather than the directory, which
+        # may still hold a just-deleted agent.
+        if sales_log is not None:
+            cursor.execute("SELECT 1 FROM agents WHERE id = %s", (int(data['agent_id']),))
+            agent_exists = cursor.fetchone() is not None
+        else:
+            agent_exists = agent_directory.exists(cursor, data['agent_id'])
+        if not agent_exists:
             return jsonify({"error": "Agent not found"}), 404
 
+        if sales_log is not None:
+            # Acknowledge once the sale is durable in the local log; the
+            # background writer inserts it with the next micro-batch.
+            sale_id = sale_id_allocator.next(cursor)
+            conn.commit()
+            sales_log.append({
+                "id": sale_id,
+                "agent_id": int(data['agent_id']),
+                "sale_amount": data['sale_amount'],
+                "product_code": data['product_code'],
+                "sale_date": data['sale_date'],
+                "additional_details": data.get('additional_details', {})
+            })
+            return jsonify({
+                "message": "Sales data received",
+                "sale_id": sale_id,
+                "agent_id": data['agent_id']
+            }), 201
+
         # Insert sales data
         cursor.execute(
             """INSERT INTO sales_data 
@@ -66,48 +124,459 @@ def receive_sales():
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# CREATE - Receive a batch of sales in one transaction
+def parse_iso_datetime(value):
+    # datetime.fromisoformat only accepts a trailing "Z" from Python 3.11 on;
+    # Postgres takes it as UTC, so accept it here too
+    value = str(value)
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+def validate_sale(data):
+    if not isinstance(data, dict):
+        return "Expected an object"
+    for field in SALE_REQUIRED_FIELDS:
+        if field not in data:
+            return f"Missing required field: {field}"
+    try:
+        int(data['agent_id'])
+    except (TypeError, ValueError):
+        return "Invalid agent_id"
+    try:
+        if isinstance(data['sale_amount'], bool):
+            raise TypeError
+        amount = float(data['sale_amount'])
+    except (TypeError, ValueError):
+        return "Invalid sale_amount"
+    if not math.isfinite(amount) or round(abs(amount), 2) >= SALE_AMOUNT_LIMIT:
+        return "Invalid sale_amount"
+    product_code = data['product_code']
+    if product_code is not None and (not isinstance(product_code, str) or len(product_code) > PRODUCT_CODE_MAX_LENGTH):
+        return f"product_code must be a string of at most {PRODUCT_CODE_MAX_LENGTH} characters"
+    # Postgres text and jsonb cannot hold NUL characters
+    if product_code is not None and "\x00" in product_code:
+        return "product_code must not contain NUL characters"
+    if "\\u0000" in json.dumps(data.get('additional_details', {})):
+        return "additional_details must not contain NUL characters"
+    try:
+        parse_iso_datetime(data['sale_date'])
+    except ValueError:
+        return "Invalid sale_date"
+    return None
+
+def find_existing_agents(cursor, agent_ids):
+    return agent_directory.existing(cursor, agent_ids)
+
+def copy_sales(cursor, sales):
+    # Returns one (sale_id, error) pair per sale
+    return copy_with_ids(
+        cursor, "sales_data", ("agent_id", "sale_amount", "product_code", "sale_date", "additional_details"),
+        [(int(data['agent_id']), data['sale_amount'], data['product_code'], data['sale_date'],
+          json.dumps(data.get('additional_details', {}))) for data in sales])
+
+@app.route('/sales-data/batch', methods=['POST'])
+def receive_sales_batch():
+    conn = None
+    cursor = None
+    try:
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return jsonify({"error": "Expected a JSON array of sales"}), 400
+
+        results = [{"row": index} for index in range(len(rows))]
+        candidates = []
+        for result, data in zip(results, rows):
+            error = validate_sale(data)
+            if error:
+                result["error"] = error
+            else:
+                candidates.append((result, data))
+
+        accepted = []
+        if candidates:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+
+            # Resolve every referenced agent with one query
+            existing = find_existing_agents(cursor, {int(data['agent_id']) for _, data in candidates})
+            for result, data in candidates:
+                if int(data['agent_id']) in existing:
+                    accepted.append((result, data))
+                else:
+                    result["error"] = "Agent not found"
+
+            if accepted:
+                inserted = copy_sales(cursor, [data for _, data in accepted])
+                for (result, _), (sale_id, error) in zip(accepted, inserted):
+                    if error:
+                        result["error"] = error
+                    else:
+                        result["sale_id"] = sale_id
+                accepted = [item for item in accepted if "sale_id" in item[0]]
+            conn.commit()
+
+        return jsonify({
+            "accepted": len(accepted),
+            "rejected": len(rows) - len(accepted),
+            "results": results
+        }), 201 if accepted else 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# CREATE - Write-behind buffer for single sales
+SALES_WRITE_BEHIND = os.environ.get("SALES_WRITE_BEHIND", "false").lower() == "true"
+SALES_WAL_DIR = os.environ.get("SALES_WAL_DIR", "sales-wal")
+SALES_FLUSH_SIZE = int(os.environ.get("SALES_FLUSH_SIZE", 500))
+SALES_FLUSH_INTERVAL = float(os.environ.get("SALES_FLUSH_INTERVAL", 0.5))
+
+class SaleIdAllocator:
+    # Hands out sale ids reserved from the sales_data sequence in blocks, so
+    # write-behind sales can be acknowledged with their final id.
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._ids = deque()
+
+    def next(self, cursor):
+        with self._lock:
+            if not self._ids:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence('sales_data', 'id')) FROM generate_series(1, %s)",
+                    (self.block_size,))
+                self._ids.extend(row[0] for row in cursor.fetchall())
+            return self._ids.popleft()
+
+def insert_buffered_sales(cursor, records):
+    execute_values(
+        cursor,
+        """INSERT INTO sales_data (id, agent_id, sale_amount, product_code, sale_date, additional_details)
+        VALUES %s ON CONFLICT (id) DO NOTHING""",
+        [(r['id'], r['agent_id'], r['sale_amount'], r['product_code'], r['sale_date'],
+          json.dumps(r['additional_details'])) for r in records],
+        page_size=1000)
+
+def dead_letter_sales(cursor, rejected):
+    # rejected holds (record, error) pairs; see migrations/014_sales_dead_letters.sql
+    execute_values(
+        cursor,
+        "INSERT INTO sales_dead_letters (sale_id, record, error) VALUES %s ON CONFLICT (sale_id) DO NOTHING",
+        [(record['id'], json.dumps(record), error) for record, error in rejected])
+
+def flush_buffered_sales(records):
+    # Called by the write-behind log; ids are fixed, so replays are no-ops.
+    # Sales that were acknowledged but cannot be inserted are moved to
+    # sales_dead_letters in the same transaction, never dropped.
+    conn = get_db_connection()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+
+        # Agents can be deleted between acknowledgement and flush, so ask the
+        # database rather than the directory
+        cursor.execute("SELECT id FROM agents WHERE id = ANY(%s)", (list({r['agent_id'] for r in records}),))
+        existing = {row[0] for row in cursor.fetchall()}
+        rejected = [(r, "Agent not found") for r in records if r['agent_id'] not in existing]
+        records = [r for r in records if r['agent_id'] in existing]
+
+        try:
+            insert_buffered_sales(cursor, records)
+        except (psycopg2.DataError, psycopg2.IntegrityError, ValueError):
+            # Isolate the bad rows so they cannot block the rest of the log
+            conn.rollback()
+            for record in records:
+                cursor.execute("SAVEPOINT buffered_sale")
+                try:
+                    insert_buffered_sales(cursor, [record])
+                    cursor.execute("RELEASE SAVEPOINT buffered_sale")
+                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT buffered_sale")
+                    rejected.append((record, e.diag.message_primary or str(e).strip()))
+                except ValueError as e:
+                    # Rejected by psycopg2 before it reached the server (a NUL byte)
+                    cursor.execute("ROLLBACK TO SAVEPOINT buffered_sale")
+                    rejected.append((record, str(e)))
+
+        if rejected:
+            dead_letter_sales(cursor, rejected)
+            app.logger.error("Moved %d buffered sale(s) to sales_dead_letters: %s",
+                             len(rejected), [record['id'] for record, _ in rejected])
+        conn.commit()
+    finally:
+        if cursor is not None:
+            cursor.close()
+        db_pool.putconn(conn)
+
+sales_log = None
+sale_id_allocator = SaleIdAllocator()
+if SALES_WRITE_BEHIND:
+    sales_log = WriteBehindLog(
+        SALES_WAL_DIR, flush_buffered_sales,
+        batch_size=SALES_FLUSH_SIZE, interval=SALES_FLUSH_INTERVAL, name="sales"
+    ).start()
+    atexit.register(sales_log.stop)
+
+# CREATE - Stream NDJSON sales, committing every chunk
+SALES_STREAM_CHUNK = int(os.environ.get("SALES_STREAM_CHUNK", 1000))
+SALES_STREAM_MAX_ERRORS = 1000
+SALES_STREAM_READ_SIZE = 64 * 1024
+
+def iter_body_lines(stream):
+    # Reads the body in fixed-size blocks; memory is bounded by the block size
+    # plus the longest line.
+    pending = b""
+    while True:
+        block = stream.read(SALES_STREAM_READ_SIZE)
+        if not block:
+            break
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+def ingest_sales_chunk(cursor, chunk):
+    # chunk is a list of (offset, data, parse_error); returns (accepted, errors)
+    errors = []
+    valid = []
+    for offset, data, error in chunk:
+        error = error or validate_sale(data)
+        if error:
+            errors.append({"offset": offset, "error": error})
+        else:
+            valid.append((offset, data))
+
+    accepted = []
+    if valid:
+        existing = find_existing_agents(cursor, {int(data['agent_id']) for _, data in valid})
+        for offset, data in valid:
+            if int(data['agent_id']) in existing:
+                accepted.append((offset, data))
+            else:
+                errors.append({"offset": offset, "error": "Agent not found"})
+    inserted = 0
+    if accepted:
+        for (offset, _), (_, error) in zip(accepted, copy_sales(cursor, [data for _, data in accepted])):
+            if error:
+                errors.append({"offset": offset, "error": error})
+            else:
+                inserted += 1
+        errors.sort(key=lambda e: e["offset"])
+    return inserted, errors
+
+@app.route('/sales-data/stream', methods=['POST'])
+def receive_sales_stream():
+    conn = None
+    cursor = None
+    upload_id = request.args.get("upload_id") or uuid.uuid4().hex
+    progress = {"upload_id": upload_id, "committed_offset": 0, "accepted": 0, "rejected": 0, "skipped": 0}
+    errors = []
+    error_count = [0]
+    try:
+        chunk_size = int(request.args.get("chunk_size", SALES_STREAM_CHUNK))
+        start_offset = int(request.args.get("start_offset", 0))
+        if chunk_size < 1 or start_offset < 0:
+            return jsonify({"error": "chunk_size must be positive and start_offset non-negative"}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "INSERT INTO sales_ingest_uploads (upload_id) VALUES (%s) ON CONFLICT (upload_id) DO NOTHING",
+            (upload_id,))
+        cursor.execute(
+            "SELECT committed_offset, accepted, rejected FROM sales_ingest_uploads WHERE upload_id = %s",
+            (upload_id,))
+        progress["committed_offset"], progress["accepted"], progress["rejected"] = cursor.fetchone()
+        conn.commit()
+
+        if start_offset > progress["committed_offset"]:
+            return jsonify(dict(progress, error="start_offset is past the committed offset; "
+                                                "resend from committed_offset")), 409
+
+        def commit_chunk(chunk, end_offset):
+            # Lock the progress row so two uploads with the same id cannot interleave
+            cursor.execute(
+                "SELECT committed_offset FROM sales_ingest_uploads WHERE upload_id = %s FOR UPDATE",
+                (upload_id,))
+            if cursor.fetchone()[0] != progress["committed_offset"]:
+                raise RuntimeError("Upload was advanced by another request")
+
+            accepted, chunk_errors = ingest_sales_chunk(cursor, chunk)
+            cursor.execute(
+                """UPDATE sales_ingest_uploads
+                SET committed_offset = %s, accepted = accepted + %s, rejected = rejected + %s,
+                    updated_at = NOW()
+                WHERE upload_id = %s""",
+                (end_offset, accepted, len(chunk_errors), upload_id))
+            conn.commit()
+
+            progress["committed_offset"] = end_offset
+            progress["accepted"] += accepted
+            progress["rejected"] += len(chunk_errors)
+            error_count[0] += len(chunk_errors)
+            errors.extend(chunk_errors[:SALES_STREAM_MAX_ERRORS - len(errors)])
+            app.logger.info("Upload %s committed through offset %s", upload_id, end_offset)
+
+        # The body is read a line at a time and only one chunk is held in memory;
+        # the client is throttled by how fast chunks commit.
+        chunk = []
+        offset = start_offset
+        for line in iter_body_lines(request.stream):
+            if offset < progress["committed_offset"]:
+                progress["skipped"] += 1
+            elif line.strip():
+                try:
+                    chunk.append((offset, json.loads(line), None))
+                except ValueError:
+                    chunk.append((offset, None, "Invalid JSON"))
+            offset += 1
+            if offset - progress["committed_offset"] >= chunk_size:
+                commit_chunk(chunk, offset)
+                chunk = []
+        if offset > progress["committed_offset"]:
+            commit_chunk(chunk, offset)
+
+        return jsonify(dict(progress, errors=errors, errors_truncated=error_count[0] > len(errors))), 200
+    except Exception as e:
+        # Everything up to committed_offset is durable; the client resumes from there
+        return jsonify(dict(progress, error=str(e), errors=errors)), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# READ - Progress of a streamed upload
+@app.route('/sales-data/stream/<upload_id>', methods=['GET'])
+def get_sales_stream_progress(upload_id):
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute(
+            """SELECT committed_offset, accepted, rejected, created_at, updated_at
+            FROM sales_ingest_uploads WHERE upload_id = %s""",
+            (upload_id,))
+        upload = cursor.fetchone()
+        if upload is None:
+            return jsonify({"error": "Upload not found"}), 404
+
+        return jsonify({
+            "upload_id": upload_id,
+            "committed_offset": upload[0],
+            "accepted": upload[1],
+            "rejected": upload[2],
+            "created_at": upload[3].isoformat(),
+            "updated_at": upload[4].isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# READ - Get sales for an agent
+SALES_PAGE_DEFAULT = 100
+SALES_PAGE_MAX = 1000
+SALES_STREAM_BATCH = 1000
+
+def sale_row_to_dict(agent_id, sale):
+    return {
+        "id": sale[0],
+        "agent_id": agent_id,
+        "sale_amount": float(sale[1]),
+        "product_code": sale[2],
+        "sale_date": sale[3].isoformat() if sale[3] else None,
+        "additional_details": sale[4] if sale[4] else {}
+    }
+
+def sales_filter(agent_id, args):
+    # from is inclusive and to is exclusive; both are ISO dates or timestamps.
+    # The conditions match idx_sales_data_agent_date and
+    # idx_sales_data_agent_product_date (migrations/004_sales_data_agent_indexes.sql).
+    conditions = ["agent_id = %s"]
+    params = [agent_id]
+    if args.get("product_code"):
+        conditions.append("product_code = %s")
+        params.append(args["product_code"])
+    for arg, operator in (("from", ">="), ("to", "<")):
+        if args.get(arg):
+            parse_iso_datetime(args[arg])
+            conditions.append(f"sale_date {operator} %s")
+            params.append(args[arg])
+    return " AND ".join(conditions), params
+
+def stream_sales(agent_id, where, params, stream_format):
+    return stream_rows(
+        db_pool, "sales_stream",
+        f"""SELECT id, sale_amount, product_code, sale_date, additional_details
+        FROM sales_data WHERE {where} ORDER BY sale_date, id""",
+        params, lambda sale: sale_row_to_dict(agent_id, sale), stream_format, SALES_STREAM_BATCH)
 
-# READ - Get all sales for an agent
 @app.route('/sales/<int:agent_id>', methods=['GET'])
 def get_sales(agent_id):
     conn = None
     cursor = None
     try:
+        where, params = sales_filter(agent_id, request.args)
+        stream_format = request.args.get("stream")
+        if stream_format is not None and stream_format not in STREAM_MIMETYPES:
+            return jsonify({"error": "stream must be 'ndjson' or 'json'"}), 400
+        limit = int(request.args.get("limit", SALES_PAGE_DEFAULT))
+        if not 1 <= limit <= SALES_PAGE_MAX:
+            return jsonify({"error": f"limit must be between 1 and {SALES_PAGE_MAX}"}), 400
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
         # Check if agent exists
-        cursor.execute("SELECT id FROM agents WHERE id = %s", (agent_id,))
-        if cursor.fetchone() is None:
+        if not agent_directory.exists(cursor, agent_id):
             return jsonify({"error": "Agent not found"}), 404
 
+        if stream_format is not None:
+            return Response(stream_sales(agent_id, where, params, stream_format),
+                            mimetype=STREAM_MIMETYPES[stream_format]), 200
+
+        # Keyset pagination on (sale_date, id)
+        if request.args.get("after_date") or request.args.get("after_id"):
+            if not (request.args.get("after_date") and request.args.get("after_id")):
+                return jsonify({"error": "after_date and after_id must be given together"}), 400
+            where += " AND (sale_date, id) > (%s, %s)"
+            params += [request.args["after_date"], int(request.args["after_id"])]
+
         # Get sales data
         cursor.execute(
-            """SELECT id, sale_amount, product_code, sale_date, additional_details 
-            FROM sales_data WHERE agent_id = %s""",
-            (agent_id,)
+            f"""SELECT id, sale_amount, product_code, sale_date, additional_details 
+            FROM sales_data WHERE {where} ORDER BY sale_date, id LIMIT %s""",
+            params + [limit]
         )
-        
-        sales = []
-        for sale in cursor.fetchall():
-            sales.append({
-                "id": sale[0],
-                "agent_id": agent_id,
-                "sale_amount": float(sale[1]),
-                "product_code": sale[2],
-                "sale_date": sale[3].isoformat() if sale[3] else None,
-                "additional_details": sale[4] if sale[4] else {}
-            })
-        
-        return jsonify(sales), 200
+        sales = [sale_row_to_dict(agent_id, sale) for sale in cursor.fetchall()]
+
+        response = jsonify(sales)
+        # A full page means there may be more; clients pass these back as after_date/after_id
+        if len(sales) == limit:
+            response.headers["X-Next-After-Date"] = sales[-1]["sale_date"]
+            response.headers["X-Next-After-Id"] = str(sales[-1]["id"])
+        return response, 200
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     finally:
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 # UPDATE - Update specific sale
 @app.route('/sales/<int:sale_id>', methods=['PUT'])
@@ -159,7 +628,7 @@ def update_sale(sale_id):
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 # DELETE - Remove specific sale
 @app.route('/sales/<int:sale_id>', methods=['DELETE'])
@@ -190,7 +659,168 @@ def delete_sale(sale_id):
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# READ - Live leaderboard
+LEADERBOARD_WINDOW_DAYS = 30
+LEADERBOARD_MAX_LIMIT = 100
+
+class Leaderboard:
+    # Running per-agent totals for the rolling 30-day and month-to-date
+    # windows, fed by the sales feed. Per-day totals are kept so days that
+    # leave a window can be subtracted as the date advances.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._today = None
+        self._by_day = {}    # day -> {agent_id: amount}
+        self._totals = {"30d": {}, "mtd": {}}
+
+    def _windows(self, day):
+        windows = []
+        if self._today - timedelta(days=LEADERBOARD_WINDOW_DAYS) <= day <= self._today:
+            windows.append("30d")
+        if self._today.replace(day=1) <= day <= self._today:
+            windows.append("mtd")
+        return windows
+
+    def _add(self, totals, agent_id, amount):
+        total = totals.get(agent_id, 0) + amount
+        if total:
+            totals[agent_id] = total
+        else:
+            totals.pop(agent_id, None)
+
+    def _advance(self, today):
+        # Step a day at a time: the oldest day leaves the 30-day window and the
+        # new day (which may already hold future-dated sales) enters it.
+        while self._today < today:
+            new_today = self._today + timedelta(days=1)
+            for agent_id, amount in self._by_day.get(new_today - timedelta(days=LEADERBOARD_WINDOW_DAYS + 1), {}).items():
+                self._add(self._totals["30d"], agent_id, -amount)
+            if new_today.month != self._today.month:
+                self._totals["mtd"] = {}
+            for agent_id, amount in self._by_day.get(new_today, {}).items():
+                self._add(self._totals["30d"], agent_id, amount)
+                self._add(self._totals["mtd"], agent_id, amount)
+            self._today = new_today
+            oldest = min(new_today - timedelta(days=LEADERBOARD_WINDOW_DAYS), new_today.replace(day=1))
+            for day in [d for d in self._by_day if d < oldest]:
+                del self._by_day[day]
+
+    def rebuild(self, cursor):
+        today = date.today()
+        oldest = min(today - timedelta(days=LEADERBOARD_WINDOW_DAYS), today.replace(day=1))
+        cursor.execute("""
+            SELECT sale_date::date, agent_id, SUM(sale_amount)
+            FROM sales_data WHERE sale_date >= %s
+            GROUP BY 1, 2
+        """, (oldest,))
+        by_day = {}
+        for day, agent_id, amount in cursor.fetchall():
+            by_day.setdefault(day, {})[agent_id] = amount
+
+        with self._lock:
+            self._today = today
+            self._by_day = by_day
+            self._totals = {"30d": {}, "mtd": {}}
+            for day, agents in by_day.items():
+                for window in self._windows(day):
+                    for agent_id, amount in agents.items():
+                        self._add(self._totals[window], agent_id, amount)
+
+    def apply(self, agent_id, day, amount, count):
+        with self._lock:
+            self._advance(date.today())
+            if day < min(self._today - timedelta(days=LEADERBOARD_WINDOW_DAYS), self._today.replace(day=1)):
+                return
+            self._add(self._by_day.setdefault(day, {}), agent_id, amount)
+            for window in self._windows(day):
+                self._add(self._totals[window], agent_id, amount)
+
+    def top(self, window, limit):
+        with self._lock:
+            self._advance(date.today())
+            return self._today, heapq.nlargest(limit, self._totals[window].items(), key=itemgetter(1))
+
+sales_feed = SalesFeed(db_pool)
+leaderboard = sales_feed.subscribe(Leaderboard())
+sales_feed.start()
+
+@app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    conn = None
+    cursor = None
+    try:
+        window = request.args.get("window", "30d")
+        limit = int(request.args.get("limit", 10))
+        if window not in ("30d", "mtd"):
+            return jsonify({"error": "window must be '30d' or 'mtd'"}), 400
+        if not 1 <= limit <= LEADERBOARD_MAX_LIMIT:
+            return jsonify({"error": f"limit must be between 1 and {LEADERBOARD_MAX_LIMIT}"}), 400
+        if not sales_feed.ready.is_set():
+            return jsonify({"error": "Leaderboard is loading"}), 503
+
+        as_of, top = leaderboard.top(window, limit)
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM agents WHERE id = ANY(%s)", ([agent_id for agent_id, _ in top],))
+        names = dict(cursor.fetchall())
+
+        return jsonify({
+            "window": window,
+            "as_of": as_of.isoformat(),
+            "top": [{
+                "rank": rank,
+                "agent_id": agent_id,
+                "name": names.get(agent_id),
+                "sales": float(sales)
+            } for rank, (agent_id, sales) in enumerate(top, 1)]
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# METRICS - Connection pool usage and wait times
+@app.route('/metrics/db-pool', methods=['GET'])
+def db_pool_metrics():
+    return jsonify(db_pool.stats()), 200
+
+# METRICS - In-memory agent directory
+@app.route('/metrics/agent-directory', methods=['GET'])
+def agent_directory_metrics():
+    return jsonify(agent_directory.stats()), 200
+
+# METRICS - Sales feed behind the leaderboard
+@app.route('/metrics/sales-feed', methods=['GET'])
+def sales_feed_metrics():
+    return jsonify(sales_feed.stats()), 200
+
+# METRICS - Write-behind log for single sales
+@app.route('/metrics/sales-write-behind', methods=['GET'])
+def sales_write_behind_metrics():
+    if sales_log is None:
+        return jsonify({"enabled": False}), 200
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # Counted from the table so every replica reports the same total
+        cursor.execute("SELECT COUNT(*) FROM sales_dead_letters")
+        dead_letters = cursor.fetchone()[0]
+        return jsonify(dict(sales_log.stats(), enabled=True, dead_letters=dead_letters)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8082)
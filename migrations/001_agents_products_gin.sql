@@ -0,0 +1,5 @@
+-- Index agents by product code.
+-- products is stored as JSON-encoded text, so index the jsonb cast of it;
+-- queries must use the same expression: products::jsonb @> '["CODE"]'
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_agents_products_gin
+    ON agents USING GIN ((products::jsonb) jsonb_path_ops);
@@ -0,0 +1,11 @@
+-- Progress of streamed NDJSON sales uploads (POST /sales-data/stream).
+-- committed_offset is the number of input lines durably processed; it is
+-- updated in the same transaction as each chunk of inserted sales.
+CREATE TABLE IF NOT EXISTS sales_ingest_uploads (
+    upload_id        TEXT PRIMARY KEY,
+    committed_offset BIGINT NOT NULL DEFAULT 0,
+    accepted         BIGINT NOT NULL DEFAULT 0,
+    rejected         BIGINT NOT NULL DEFAULT 0,
+    created_at       TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at       TIMESTAMP NOT NULL DEFAULT NOW()
+);
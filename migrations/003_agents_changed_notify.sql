@@ -0,0 +1,18 @@
+-- Publish agent inserts and deletes so services can keep an in-memory
+-- agent-id directory current (common/agent_directory.py).
+-- Payload is '<op>:<id>' where op is I (insert) or D (delete).
+CREATE OR REPLACE FUNCTION notify_agents_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('agents_changed', 'D:' || OLD.id);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('agents_changed', 'I:' || NEW.id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS agents_changed ON agents;
+CREATE TRIGGER agents_changed
+    AFTER INSERT OR DELETE ON agents
+    FOR EACH ROW EXECUTE FUNCTION notify_agents_changed();
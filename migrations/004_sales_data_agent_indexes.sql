@@ -0,0 +1,7 @@
+-- Per-agent sales lookups (GET /sales/<agent_id>): date-range filters and
+-- keyset pagination on (sale_date, id), optionally narrowed to one product.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sales_data_agent_date
+    ON sales_data (agent_id, sale_date, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sales_data_agent_product_date
+    ON sales_data (agent_id, product_code, sale_date, id);
@@ -0,0 +1,87 @@
+-- Per-day sales rollups read by the aggregator's reports.
+--
+-- Any statement that inserts, updates or deletes sales_data logs the days it
+-- touched in sales_rollup_dirty_days, as does moving an agent to another
+-- branch. refresh_daily_rollups() in aggregator_service.py consumes that log
+-- and re-aggregates only those days. The log is append-only (no dedup) so a
+-- day logged by a transaction that commits mid-refresh is never lost.
+CREATE TABLE IF NOT EXISTS sales_daily_agent (
+    day         DATE    NOT NULL,
+    agent_id    INT     NOT NULL,
+    sale_count  BIGINT  NOT NULL,
+    total_sales NUMERIC NOT NULL,
+    PRIMARY KEY (day, agent_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_product (
+    day          DATE    NOT NULL,
+    product_code TEXT    NOT NULL,
+    sale_count   BIGINT  NOT NULL,
+    total_sales  NUMERIC NOT NULL,
+    PRIMARY KEY (day, product_code)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_branch (
+    day         DATE    NOT NULL,
+    branch_id   INT     NOT NULL,
+    sale_count  BIGINT  NOT NULL,
+    total_sales NUMERIC NOT NULL,
+    PRIMARY KEY (day, branch_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_rollup_dirty_days (
+    id  BIGSERIAL PRIMARY KEY,
+    day DATE NOT NULL
+);
+
+-- Re-aggregating a day is a range scan on sale_date
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sales_data_sale_date ON sales_data (sale_date);
+
+CREATE OR REPLACE FUNCTION log_sales_dirty_days() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO sales_rollup_dirty_days (day)
+        SELECT DISTINCT sale_date::date FROM new_rows WHERE sale_date IS NOT NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO sales_rollup_dirty_days (day)
+        SELECT DISTINCT sale_date::date FROM old_rows WHERE sale_date IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_dirty_days_insert ON sales_data;
+CREATE TRIGGER sales_dirty_days_insert
+    AFTER INSERT ON sales_data REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_sales_dirty_days();
+
+DROP TRIGGER IF EXISTS sales_dirty_days_update ON sales_data;
+CREATE TRIGGER sales_dirty_days_update
+    AFTER UPDATE ON sales_data REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_sales_dirty_days();
+
+DROP TRIGGER IF EXISTS sales_dirty_days_delete ON sales_data;
+CREATE TRIGGER sales_dirty_days_delete
+    AFTER DELETE ON sales_data REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_sales_dirty_days();
+
+-- Branch rollups follow the agent's current branch
+CREATE OR REPLACE FUNCTION log_agent_branch_dirty_days() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sales_rollup_dirty_days (day)
+    SELECT DISTINCT sale_date::date FROM sales_data
+    WHERE agent_id = NEW.id AND sale_date IS NOT NULL;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS agents_branch_dirty_days ON agents;
+CREATE TRIGGER agents_branch_dirty_days
+    AFTER UPDATE OF branch_id ON agents
+    FOR EACH ROW WHEN (OLD.branch_id IS DISTINCT FROM NEW.branch_id)
+    EXECUTE FUNCTION log_agent_branch_dirty_days();
+
+-- Seed the log so the first refresh builds the full history
+INSERT INTO sales_rollup_dirty_days (day)
+SELECT DISTINCT sale_date::date FROM sales_data WHERE sale_date IS NOT NULL;
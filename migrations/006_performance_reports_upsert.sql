@@ -0,0 +1,22 @@
+-- One report per (report_date, report_type), so regenerating a day (daily
+-- cron re-runs, backfills) replaces it instead of adding a duplicate.
+ALTER TABLE performance_reports
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+-- Keep only the newest row of any existing duplicates
+DELETE FROM performance_reports p
+USING performance_reports newer
+WHERE newer.report_date = p.report_date
+  AND newer.report_type = p.report_type
+  AND newer.id > p.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_performance_reports_date_type
+    ON performance_reports (report_date, report_type);
+
+-- Days completed by each backfill run, so an interrupted run can resume
+CREATE TABLE IF NOT EXISTS report_backfill_progress (
+    run_id       TEXT NOT NULL,
+    report_date  DATE NOT NULL,
+    completed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, report_date)
+);
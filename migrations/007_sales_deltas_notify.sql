@@ -0,0 +1,61 @@
+-- Publish per-(agent, day) changes to sales totals on the sales_deltas
+-- channel, for in-memory running totals (common/sales_feed.py).
+--
+-- Each statement sends one or more notifications. The first line of a payload
+-- is '<transaction id>:<sequence number>'; every further line is
+-- '<agent_id>,<day>,<amount delta>,<count delta>'. Listeners compare the
+-- transaction id with the snapshot they rebuilt from to avoid double counting.
+-- Postgres folds identical payloads sent by one transaction into one
+-- notification, so the sequence number keeps two statements with the same
+-- deltas (two equal sales inserted one by one) from losing one of them.
+CREATE SEQUENCE IF NOT EXISTS sales_deltas_seq;
+
+CREATE OR REPLACE FUNCTION notify_sales_deltas() RETURNS trigger AS $$
+DECLARE
+    lines TEXT[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        lines := ARRAY(
+            SELECT agent_id || ',' || sale_date::date || ',' || SUM(sale_amount) || ',' || COUNT(*)
+            FROM new_rows WHERE sale_date IS NOT NULL
+            GROUP BY agent_id, sale_date::date);
+    ELSIF TG_OP = 'DELETE' THEN
+        lines := ARRAY(
+            SELECT agent_id || ',' || sale_date::date || ',' || -SUM(sale_amount) || ',' || -COUNT(*)
+            FROM old_rows WHERE sale_date IS NOT NULL
+            GROUP BY agent_id, sale_date::date);
+    ELSE
+        lines := ARRAY(
+            SELECT agent_id || ',' || day || ',' || SUM(amount) || ',' || SUM(cnt)
+            FROM (
+                SELECT agent_id, sale_date::date AS day, sale_amount AS amount, 1 AS cnt FROM new_rows
+                UNION ALL
+                SELECT agent_id, sale_date::date, -sale_amount, -1 FROM old_rows
+            ) changes
+            WHERE day IS NOT NULL
+            GROUP BY agent_id, day
+            HAVING SUM(amount) <> 0 OR SUM(cnt) <> 0);
+    END IF;
+
+    -- 150 lines keep each payload well under the 8000 byte NOTIFY limit
+    PERFORM pg_notify('sales_deltas', txid_current() || ':' || nextval('sales_deltas_seq') || E'\n'
+                                      || array_to_string(lines[i:i + 149], E'\n'))
+    FROM generate_series(1, COALESCE(array_length(lines, 1), 0), 150) AS i;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_deltas_insert ON sales_data;
+CREATE TRIGGER sales_deltas_insert
+    AFTER INSERT ON sales_data REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_sales_deltas();
+
+DROP TRIGGER IF EXISTS sales_deltas_update ON sales_data;
+CREATE TRIGGER sales_deltas_update
+    AFTER UPDATE ON sales_data REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_sales_deltas();
+
+DROP TRIGGER IF EXISTS sales_deltas_delete ON sales_data;
+CREATE TRIGGER sales_deltas_delete
+    AFTER DELETE ON sales_data REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_sales_deltas();
@@ -0,0 +1,5 @@
+-- Bulk target-achievement checks (POST /check-target-achievements/bulk) skip
+-- agents already congratulated this month.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_achievement_agent_created
+    ON notifications (agent_id, created_at)
+    WHERE notification_type = 'achievement';
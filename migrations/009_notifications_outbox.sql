@@ -0,0 +1,13 @@
+-- Outbox delivery (notification-service/delivery.py). Requests insert
+-- notifications as 'pending'; delivery workers claim due rows, move them to
+-- 'sending' and finally to 'sent' or 'failed'.
+ALTER TABLE notifications
+    ADD COLUMN IF NOT EXISTS channels TEXT[],
+    ADD COLUMN IF NOT EXISTS delivered_channels TEXT[] NOT NULL DEFAULT '{}',
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_outbox_due
+    ON notifications (next_attempt_at, id)
+    WHERE status IN ('pending', 'sending');
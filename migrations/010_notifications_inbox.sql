@@ -0,0 +1,29 @@
+-- Notification inbox (GET /notifications/<agent_id>): keyset paging on
+-- (created_at, id), unread counts and "changes since" polling.
+--
+-- change_txid records the transaction that last inserted or updated a row.
+-- A poll returns rows changed at or after the xmin of the previous poll's
+-- snapshot, so changes committed late by long transactions are not missed.
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS change_txid BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION set_notification_change_txid() RETURNS trigger AS $$
+BEGIN
+    NEW.change_txid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notifications_change_txid ON notifications;
+CREATE TRIGGER notifications_change_txid
+    BEFORE INSERT OR UPDATE ON notifications
+    FOR EACH ROW EXECUTE FUNCTION set_notification_change_txid();
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_agent_created
+    ON notifications (agent_id, created_at, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_agent_unread
+    ON notifications (agent_id)
+    WHERE read_at IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_agent_change
+    ON notifications (agent_id, change_txid, id);
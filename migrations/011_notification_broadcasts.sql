@@ -0,0 +1,22 @@
+-- Broadcast notifications (POST /broadcasts): one row per broadcast, with its
+-- recipients' notifications linked through notifications.broadcast_id.
+CREATE TABLE IF NOT EXISTS notification_broadcasts (
+    id BIGSERIAL PRIMARY KEY,
+    target_type TEXT NOT NULL,
+    target_value TEXT,
+    message TEXT NOT NULL,
+    notification_type TEXT NOT NULL,
+    recipients INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE notifications
+    ADD COLUMN IF NOT EXISTS broadcast_id BIGINT REFERENCES notification_broadcasts (id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_broadcast
+    ON notifications (broadcast_id)
+    WHERE broadcast_id IS NOT NULL;
+
+-- Branch-targeted broadcasts select recipients by branch
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_agents_branch
+    ON agents (branch_id);
@@ -0,0 +1,21 @@
+-- Notification coalescing (POST /send-notification).
+--
+-- dedupe_key identifies sends to one agent with the same caller-supplied
+-- key; repeats within the dedupe window only bump
+-- suppressed_count/last_suppressed_at on the notification that was kept. Low-priority notifications may be 'held'
+-- and later folded into one 'digest' notification per agent; the held rows
+-- become 'digested' and point at it through digest_id.
+ALTER TABLE notifications
+    ADD COLUMN IF NOT EXISTS dedupe_key TEXT,
+    ADD COLUMN IF NOT EXISTS suppressed_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_suppressed_at TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS priority TEXT NOT NULL DEFAULT 'normal',
+    ADD COLUMN IF NOT EXISTS digest_id INTEGER REFERENCES notifications (id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_dedupe
+    ON notifications (dedupe_key, created_at)
+    WHERE dedupe_key IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notifications_held
+    ON notifications (agent_id, id)
+    WHERE status = 'held';
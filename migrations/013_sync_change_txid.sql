@@ -0,0 +1,73 @@
+-- Incremental Redshift sync (redshift-publisher-service): change_txid records
+-- the transaction that last inserted or updated each row. A sync exports
+-- rows with change_txid at or above the previous run's snapshot xmin, so
+-- edits and rows committed late by long transactions are never skipped.
+--
+-- The column is added without a default and the default set separately, so
+-- existing rows are not rewritten; they keep NULL and are covered by each
+-- table's first (full) sync.
+CREATE OR REPLACE FUNCTION set_change_txid() RETURNS trigger AS $$
+BEGIN
+    NEW.change_txid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE agents ADD COLUMN IF NOT EXISTS change_txid BIGINT;
+ALTER TABLE agents ALTER COLUMN change_txid SET DEFAULT txid_current();
+DROP TRIGGER IF EXISTS agents_change_txid ON agents;
+CREATE TRIGGER agents_change_txid
+    BEFORE UPDATE ON agents
+    FOR EACH ROW EXECUTE FUNCTION set_change_txid();
+
+ALTER TABLE sales_data ADD COLUMN IF NOT EXISTS change_txid BIGINT;
+ALTER TABLE sales_data ALTER COLUMN change_txid SET DEFAULT txid_current();
+DROP TRIGGER IF EXISTS sales_data_change_txid ON sales_data;
+CREATE TRIGGER sales_data_change_txid
+    BEFORE UPDATE ON sales_data
+    FOR EACH ROW EXECUTE FUNCTION set_change_txid();
+
+ALTER TABLE performance_reports ADD COLUMN IF NOT EXISTS change_txid BIGINT;
+ALTER TABLE performance_reports ALTER COLUMN change_txid SET DEFAULT txid_current();
+DROP TRIGGER IF EXISTS performance_reports_change_txid ON performance_reports;
+CREATE TRIGGER performance_reports_change_txid
+    BEFORE UPDATE ON performance_reports
+    FOR EACH ROW EXECUTE FUNCTION set_change_txid();
+
+-- Deletes leave a tombstone stamped the same way, so the sync can remove
+-- the rows from the warehouse. Cascaded deletes (an agent's sales) fire the
+-- sales_data trigger too. The publisher prunes tombstones once the target
+-- has synced past them.
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    table_name TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    change_txid BIGINT NOT NULL DEFAULT txid_current(),
+    deleted_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_table_txid ON sync_tombstones (table_name, change_txid);
+
+CREATE OR REPLACE FUNCTION record_sync_tombstones() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sync_tombstones (table_name, id) SELECT TG_TABLE_NAME, id FROM old_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS agents_sync_tombstones ON agents;
+CREATE TRIGGER agents_sync_tombstones
+    AFTER DELETE ON agents REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_sync_tombstones();
+
+DROP TRIGGER IF EXISTS sales_data_sync_tombstones ON sales_data;
+CREATE TRIGGER sales_data_sync_tombstones
+    AFTER DELETE ON sales_data REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_sync_tombstones();
+
+DROP TRIGGER IF EXISTS performance_reports_sync_tombstones ON performance_reports;
+CREATE TRIGGER performance_reports_sync_tombstones
+    AFTER DELETE ON performance_reports REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_sync_tombstones();
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_agents_change_txid ON agents (change_txid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sales_data_change_txid ON sales_data (change_txid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_performance_reports_change_txid ON performance_reports (change_txid);
@@ -0,0 +1,11 @@
+-- Write-behind sales (SALES_WRITE_BEHIND=true) that were acknowledged but
+-- rejected when flushed, e.g. because the agent was deleted in between. They
+-- are inserted in the same transaction as the rest of their batch, so every
+-- acknowledged sale ends up either in sales_data or here. record is the
+-- logged JSON, kept as text so any value that failed can be stored.
+CREATE TABLE IF NOT EXISTS sales_dead_letters (
+    sale_id    BIGINT PRIMARY KEY,
+    record     TEXT NOT NULL,
+    error      TEXT NOT NULL,
+    failed_at  TIMESTAMP NOT NULL DEFAULT NOW()
+);
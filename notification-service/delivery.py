@@ -0,0 +1,211 @@
+# delivery.py
+# Outbox delivery for the notifications table.
+#
+# Requests only insert a 'pending' row. Worker threads claim due rows in
+# batches with FOR UPDATE SKIP LOCKED, so any number of workers and replicas
+# can share the outbox, and mark them 'sending' with a lease: a row whose
+# worker died is claimed again once next_attempt_at passes. Each row is
+# handed to the adapter of every channel it still has to reach; the outcome
+# is written back in one statement per batch. Failed rows go back to
+# 'pending' with exponential backoff until max_attempts, then 'failed'.
+import json
+import logging
+import random
+import smtplib
+import threading
+import urllib.request
+from datetime import datetime
+from email.message import EmailMessage
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+
+class SmtpChannel:
+    def __init__(self, host="localhost", port=1025, sender="notifications@moon-agent.local",
+                 address_template="agent-{agent_id}@moon-agent.local", username=None, password=None,
+                 starttls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.address_template = address_template
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, notification):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = self.address_template.format(**notification)
+        message["Subject"] = "Moon Agent %s" % notification["notification_type"]
+        message.set_content(notification["message"])
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+
+
+class HttpSmsChannel:
+    # Posts {"agent_id", "message"} to an SMS gateway, which resolves the number
+    def __init__(self, url="http://localhost:8099/messages", api_key=None, timeout=10):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def send(self, notification):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = "Bearer " + self.api_key
+        body = json.dumps({"agent_id": notification["agent_id"], "message": notification["message"]})
+        req = urllib.request.Request(self.url, data=body.encode("utf-8"), headers=headers, method="POST")
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            response.read()
+
+
+class DeliveryWorkers:
+    def __init__(self, pool, channels, workers=4, batch_size=20, max_attempts=8, backoff_base=5,
+                 backoff_max=3600, lease=600, poll_interval=1):
+        self.pool = pool
+        self.channels = channels
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"claimed": 0, "sent": 0, "retried": 0, "failed": 0, "channel_errors": 0, "worker_errors": 0}
+
+    def start(self):
+        for n in range(self.workers):
+            threading.Thread(target=self._run, name="delivery-%d" % n, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        # Called after an insert so a local worker picks it up without waiting
+        # for the next poll
+        self._wake.set()
+
+    def _claim(self, cursor):
+        # Rows inserted without channels get them from the agent's preferences
+        # now, and keep them for any retries.
+        cursor.execute("""
+            WITH due AS (
+                SELECT id FROM notifications
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE notifications n
+            SET status = 'sending',
+                attempts = n.attempts + 1,
+                next_attempt_at = NOW() + %s * INTERVAL '1 second',
+                channels = COALESCE(n.channels, (
+                    SELECT ARRAY_REMOVE(ARRAY[
+                        CASE WHEN np.email_notifications THEN 'email' END,
+                        CASE WHEN np.sms_notifications THEN 'sms' END
+                    ], NULL)
+                    FROM notification_preferences np WHERE np.agent_id = n.agent_id
+                ), ARRAY['email'])
+            FROM due
+            WHERE n.id = due.id
+            RETURNING n.id, n.agent_id, n.message, n.notification_type, n.channels,
+                      n.delivered_channels, n.attempts
+        """, (self.batch_size, self.lease))
+        return [{
+            "id": r[0], "agent_id": r[1], "message": r[2], "notification_type": r[3],
+            "channels": r[4], "delivered_channels": r[5], "attempts": r[6]
+        } for r in cursor.fetchall()]
+
+    def _deliver(self, notification):
+        delivered = list(notification["delivered_channels"])
+        errors = []
+        for channel in notification["channels"]:
+            if channel in delivered:
+                continue
+            adapter = self.channels.get(channel)
+            try:
+                if adapter is None:
+                    raise LookupError("no adapter for channel %r" % channel)
+                adapter.send(notification)
+                delivered.append(channel)
+            except Exception as e:
+                errors.append("%s: %s" % (channel, e))
+        return delivered, "; ".join(errors) or None
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def process_batch(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            batch = self._claim(cursor)
+            conn.commit()
+        if not batch:
+            return 0
+
+        # No connection is held while talking to the providers
+        results = []
+        counts = {"sent": 0, "retried": 0, "failed": 0}
+        for notification in batch:
+            delivered, error = self._deliver(notification)
+            if error is None:
+                status, retry_in = "sent", 0
+            elif notification["attempts"] >= self.max_attempts:
+                status, retry_in = "failed", 0
+            else:
+                status, retry_in = "pending", self._backoff(notification["attempts"])
+            counts["retried" if status == "pending" else status] += 1
+            # sent_at is UTC, like the rest of the notifications table
+            sent_at = datetime.utcnow() if status == "sent" else None
+            results.append((notification["id"], status, delivered, error, retry_in, sent_at))
+
+        with self.pool.connection() as conn:
+            execute_values(conn.cursor(), """
+                UPDATE notifications n
+                SET status = r.status,
+                    delivered_channels = r.delivered,
+                    last_error = r.error,
+                    sent_at = COALESCE(r.sent_at, n.sent_at),
+                    next_attempt_at = NOW() + r.retry_in * INTERVAL '1 second'
+                FROM (VALUES %s) AS r (id, status, delivered, error, retry_in, sent_at)
+                WHERE n.id = r.id
+            """, results, template="(%s, %s, %s::text[], %s, %s::float8, %s::timestamp)")
+            conn.commit()
+
+        with self._lock:
+            self._stats["claimed"] += len(batch)
+            self._stats["channel_errors"] += sum(1 for r in results if r[3])
+            for key, count in counts.items():
+                self._stats[key] += count
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.process_batch() == self.batch_size:
+                    continue
+            except Exception:
+                logger.exception("Notification delivery batch failed")
+                with self._lock:
+                    self._stats["worker_errors"] += 1
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, workers=self.workers, batch_size=self.batch_size,
+                        channels=sorted(self.channels))
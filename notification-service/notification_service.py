@@ -1,26 +1,385 @@
 # notification_service.py
 from flask import Flask, request, jsonify
-import psycopg2
+import hashlib
 import json
-from datetime import datetime
+import logging
+import os
+import queue
+import threading
+import time
+from common.agent_directory import AgentDirectory
+from common.cache import TTLCache
+from common.db import ConnectionPool
+from common.sales_feed import SalesFeed
+from datetime import date, datetime
+from delivery import DeliveryWorkers, HttpSmsChannel, SmtpChannel
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 # PostgreSQL connection parameters
-DB_HOST = "localhost"
-DB_NAME = "moon-agent"
-DB_USER = "admin"
-DB_PASS = "password"
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_NAME = os.environ.get("DB_NAME", "moon-agent")
+DB_USER = os.environ.get("DB_USER", "admin")
+DB_PASS = os.environ.get("DB_PASS", "password")
+DB_PORT = int(os.environ.get("DB_PORT", 5432))
+
+db_pool = ConnectionPool.from_env(
+    host=DB_HOST,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    port=DB_PORT
+)
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        port=5432
-    )
-    return conn
+    return db_pool.getconn()
+
+agent_directory = AgentDirectory(
+    db_pool, reload_interval=float(os.environ.get("AGENT_DIRECTORY_RELOAD_INTERVAL", 300))
+).start()
+
+# Outbox delivery (see delivery.py). Set DELIVERY_WORKERS=0 on replicas that
+# should only accept requests.
+delivery_workers = DeliveryWorkers(
+    db_pool,
+    channels={
+        "email": SmtpChannel(
+            host=os.environ.get("SMTP_HOST", "localhost"),
+            port=int(os.environ.get("SMTP_PORT", 1025)),
+            sender=os.environ.get("SMTP_SENDER", "notifications@moon-agent.local"),
+            address_template=os.environ.get("EMAIL_ADDRESS_TEMPLATE", "agent-{agent_id}@moon-agent.local"),
+            username=os.environ.get("SMTP_USER"),
+            password=os.environ.get("SMTP_PASSWORD"),
+            starttls=os.environ.get("SMTP_STARTTLS", "false").lower() == "true"
+        ),
+        "sms": HttpSmsChannel(
+            url=os.environ.get("SMS_GATEWAY_URL", "http://localhost:8099/messages"),
+            api_key=os.environ.get("SMS_GATEWAY_API_KEY")
+        ),
+    },
+    workers=int(os.environ.get("DELIVERY_WORKERS", 4)),
+    batch_size=int(os.environ.get("DELIVERY_BATCH_SIZE", 20)),
+    max_attempts=int(os.environ.get("DELIVERY_MAX_ATTEMPTS", 8)),
+    backoff_base=float(os.environ.get("DELIVERY_BACKOFF_BASE", 5)),
+    backoff_max=float(os.environ.get("DELIVERY_BACKOFF_MAX", 3600))
+).start()
+
+# Serialises achievement inserts so an agent is never congratulated twice a month
+ACHIEVEMENT_CHECK_LOCK = 5002
+
+def insert_achievement(cursor, agent_id, total_sales):
+    # Congratulates the agent if total_sales reaches their target and they have
+    # not been congratulated this month; the check and insert are one
+    # statement under ACHIEVEMENT_CHECK_LOCK. Returns the notification id, or
+    # None if nothing was sent. The caller commits.
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ACHIEVEMENT_CHECK_LOCK,))
+    cursor.execute("""
+        INSERT INTO notifications (agent_id, message, notification_type, status)
+        SELECT np.agent_id,
+               'Congratulations! You''ve achieved your monthly sales target of $'
+                   || ROUND(np.sales_target_threshold, 2)::text,
+               'achievement', 'pending'
+        FROM notification_preferences np
+        WHERE np.agent_id = %s
+          AND np.sales_target_threshold <= %s
+          AND NOT EXISTS (
+              SELECT 1 FROM notifications n
+              WHERE n.agent_id = np.agent_id
+                AND n.notification_type = 'achievement'
+                AND n.created_at >= DATE_TRUNC('month', CURRENT_DATE)
+          )
+        RETURNING id
+    """, (agent_id, total_sales))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Month-to-date totals per agent, kept current from the sales feed, so a
+# target is detected as soon as the sale that reaches it is committed.
+# Thresholds are reloaded every refresh_interval seconds, so changes made
+# through other replicas are picked up.
+class TargetTracker:
+    def __init__(self, pool, retry_interval=5, refresh_interval=60):
+        self.pool = pool
+        self.retry_interval = retry_interval
+        self.refresh_interval = refresh_interval
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._month = None
+        self._months = {}       # month start -> {agent_id: sales}, current and future months
+        self._totals = {}       # agent_id -> sales on or after the current month start
+        self._thresholds = {}   # agent_id -> sales_target_threshold
+        self._notified = set()  # agents congratulated this month
+        self._due = queue.Queue()
+        self._stats = {"crossings": 0, "notifications_sent": 0, "already_notified": 0,
+                       "stale_thresholds": 0, "errors": 0}
+
+    def start(self):
+        threading.Thread(target=self._run, name="target-tracker", daemon=True).start()
+        return self
+
+    def _roll(self, today):
+        month = today.replace(day=1)
+        if month == self._month:
+            return
+        for start in [m for m in self._months if m < month]:
+            for agent_id, amount in self._months.pop(start).items():
+                self._totals[agent_id] -= amount
+        self._month = month
+        self._notified = set()
+
+    def _check(self, agent_id):
+        # Caller must hold self._lock
+        threshold = self._thresholds.get(agent_id)
+        if threshold is not None and agent_id not in self._notified and self._totals.get(agent_id, 0) >= threshold:
+            self._stats["crossings"] += 1
+            self._due.put(agent_id)
+
+    def rebuild(self, cursor):
+        month = date.today().replace(day=1)
+        cursor.execute("""
+            SELECT agent_id, DATE_TRUNC('month', sale_date)::date, SUM(sale_amount)
+            FROM sales_data WHERE sale_date >= %s
+            GROUP BY 1, 2
+        """, (month,))
+        months = {}
+        totals = {}
+        for agent_id, start, amount in cursor.fetchall():
+            months.setdefault(start, {})[agent_id] = amount
+            totals[agent_id] = totals.get(agent_id, 0) + amount
+        cursor.execute("SELECT agent_id, sales_target_threshold FROM notification_preferences WHERE sales_target_threshold IS NOT NULL")
+        thresholds = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT DISTINCT agent_id FROM notifications
+            WHERE notification_type = 'achievement' AND created_at >= %s
+        """, (month,))
+        notified = {row[0] for row in cursor.fetchall()}
+
+        with self._lock:
+            self._month = month
+            self._months = months
+            self._totals = totals
+            self._thresholds = thresholds
+            self._last_refresh = time.monotonic()
+            self._notified = notified
+            # Catch up on targets reached while the feed was down
+            for agent_id in totals:
+                self._check(agent_id)
+
+    def apply(self, agent_id, day, amount, count):
+        with self._lock:
+            self._roll(date.today())
+            if day < self._month:
+                return
+            month = day.replace(day=1)
+            self._months.setdefault(month, {})
+            self._months[month][agent_id] = self._months[month].get(agent_id, 0) + amount
+            self._totals[agent_id] = self._totals.get(agent_id, 0) + amount
+            self._check(agent_id)
+
+    def refresh_thresholds(self):
+        conn = self.pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT agent_id, sales_target_threshold FROM notification_preferences WHERE sales_target_threshold IS NOT NULL")
+            thresholds = dict(cursor.fetchall())
+            cursor.close()
+        finally:
+            self.pool.putconn(conn)
+        with self._lock:
+            self._thresholds = thresholds
+            self._last_refresh = time.monotonic()
+            # A lowered threshold may already be reached
+            for agent_id in self._totals:
+                self._check(agent_id)
+
+    def set_threshold(self, agent_id, threshold):
+        with self._lock:
+            if threshold is None:
+                self._thresholds.pop(agent_id, None)
+            else:
+                self._thresholds[agent_id] = threshold
+                self._check(agent_id)
+
+    def _notify(self, agent_id):
+        # Every replica runs a tracker, so the insert re-checks the threshold and
+        # this month's notifications; only the first replica to get there sends
+        # the notification.
+        with self._lock:
+            total = self._totals.get(agent_id, 0)
+        conn = self.pool.getconn()
+        try:
+            cursor = conn.cursor()
+            sent = insert_achievement(cursor, agent_id, total) is not None
+            conn.commit()
+            if not sent:
+                # Either already congratulated, or the threshold cached here is
+                # stale; keep watching the agent unless it was the former
+                cursor.execute("""
+                    SELECT EXISTS (
+                               SELECT 1 FROM notifications
+                               WHERE agent_id = %s AND notification_type = 'achievement'
+                                 AND created_at >= DATE_TRUNC('month', CURRENT_DATE)),
+                           (SELECT sales_target_threshold FROM notification_preferences WHERE agent_id = %s)
+                """, (agent_id, agent_id))
+                already_notified, threshold = cursor.fetchone()
+                conn.commit()
+            cursor.close()
+        finally:
+            self.pool.putconn(conn)
+        if sent:
+            delivery_workers.wake()
+        with self._lock:
+            if sent or already_notified:
+                self._notified.add(agent_id)
+                self._stats["notifications_sent" if sent else "already_notified"] += 1
+            elif threshold is None:
+                self._thresholds.pop(agent_id, None)
+                self._stats["stale_thresholds"] += 1
+            else:
+                self._thresholds[agent_id] = threshold
+                self._stats["stale_thresholds"] += 1
+
+    def _run(self):
+        while True:
+            try:
+                agent_id = self._due.get(timeout=self.refresh_interval)
+            except queue.Empty:
+                agent_id = None
+            if time.monotonic() - self._last_refresh >= self.refresh_interval:
+                try:
+                    self.refresh_thresholds()
+                except Exception:
+                    logger.exception("Failed to refresh sales targets; will retry")
+                    self._last_refresh = time.monotonic()
+            if agent_id is None:
+                continue
+            try:
+                self._notify(agent_id)
+            except Exception:
+                logger.exception("Failed to send achievement notification to agent %s; will retry", agent_id)
+                with self._lock:
+                    self._stats["errors"] += 1
+                time.sleep(self.retry_interval)
+                self._due.put(agent_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, agents=len(self._totals), pending=self._due.qsize(),
+                        notified=len(self._notified), month=self._month.isoformat() if self._month else None)
+
+target_tracker = TargetTracker(
+    db_pool, refresh_interval=float(os.environ.get("TARGET_THRESHOLD_REFRESH_INTERVAL", 60))
+).start()
+sales_feed = SalesFeed(db_pool)
+sales_feed.subscribe(target_tracker)
+sales_feed.start()
+
+# Notification preferences, cached per agent. Agents without a row are cached
+# as NO_PREFERENCES so the default path skips the database as well. PUT
+# refreshes the local entry; other replicas pick it up within the TTL.
+PREFERENCE_FIELDS = ['email_notifications', 'sms_notifications',
+                     'push_notifications', 'sales_target_threshold']
+NO_PREFERENCES = object()
+
+preferences_cache = TTLCache(
+    maxsize=int(os.environ.get("PREFERENCES_CACHE_SIZE", 50000)),
+    ttl=float(os.environ.get("PREFERENCES_CACHE_TTL", 60))
+)
+
+def get_preferences(cursor, agent_id):
+    prefs = preferences_cache.get(agent_id)
+    if prefs is None:
+        generation = preferences_cache.generation()
+        cursor.execute(
+            f"SELECT {', '.join(PREFERENCE_FIELDS)} FROM notification_preferences WHERE agent_id = %s",
+            (agent_id,)
+        )
+        row = cursor.fetchone()
+        prefs = dict(zip(PREFERENCE_FIELDS, row)) if row else NO_PREFERENCES
+        preferences_cache.set(agent_id, prefs, generation=generation)
+    return prefs
+
+def delivery_channels(prefs):
+    # Default to email if no preferences set
+    if prefs is NO_PREFERENCES:
+        return ["email"]
+    channels = []
+    if prefs['email_notifications']:
+        channels.append("email")
+    if prefs['sms_notifications']:
+        channels.append("sms")
+    return channels
+
+# Coalescing: sends to the same agent with the same caller-supplied
+# dedupe_key within NOTIFICATION_DEDUPE_WINDOW seconds are folded into the
+# first one (0 turns this off). Sends without a dedupe_key are never folded,
+# so callers that repeat a notification on purpose keep getting it. With
+# NOTIFICATION_DIGEST_INTERVAL set, low-priority notifications are held and
+# sent as one digest per agent each interval.
+NOTIFICATION_DEDUPE_WINDOW = float(os.environ.get("NOTIFICATION_DEDUPE_WINDOW", 3600))
+NOTIFICATION_DIGEST_INTERVAL = float(os.environ.get("NOTIFICATION_DIGEST_INTERVAL", 0))
+NOTIFICATION_PRIORITIES = ('low', 'normal', 'high')
+
+coalescing_stats = {"queued": 0, "held": 0, "coalesced": 0, "digests": 0, "digested": 0}
+coalescing_lock = threading.Lock()
+
+def count_coalescing(key, n=1):
+    with coalescing_lock:
+        coalescing_stats[key] += n
+
+def dedupe_key(agent_id, key):
+    # Scoped to the agent so callers' keys cannot collide across agents
+    return hashlib.sha1(f"{agent_id}:{key}".encode("utf-8")).hexdigest()
+
+def send_digests():
+    # Folds every held notification into one digest per agent, in one statement.
+    # SKIP LOCKED lets several replicas run this at once.
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH held AS MATERIALIZED (
+                SELECT id, agent_id, message FROM notifications
+                WHERE status = 'held'
+                FOR UPDATE SKIP LOCKED
+            ), digests AS (
+                INSERT INTO notifications (agent_id, message, notification_type, status)
+                SELECT agent_id,
+                       'You have ' || COUNT(*) || ' new notifications:' || E'\n'
+                           || STRING_AGG('- ' || message, E'\n' ORDER BY id),
+                       'digest', 'pending'
+                FROM held
+                GROUP BY agent_id
+                RETURNING id, agent_id
+            ), folded AS (
+                UPDATE notifications n
+                SET status = 'digested', digest_id = d.id
+                FROM held h
+                JOIN digests d ON d.agent_id = h.agent_id
+                WHERE n.id = h.id
+                RETURNING n.id
+            )
+            SELECT (SELECT COUNT(*) FROM digests), (SELECT COUNT(*) FROM folded)
+        """)
+        digests, folded = cursor.fetchone()
+        conn.commit()
+    if digests:
+        count_coalescing("digests", digests)
+        count_coalescing("digested", folded)
+        delivery_workers.wake()
+    return digests
+
+def run_digests():
+    while True:
+        time.sleep(NOTIFICATION_DIGEST_INTERVAL)
+        try:
+            send_digests()
+        except Exception:
+            logger.exception("Failed to send notification digests")
+
+if NOTIFICATION_DIGEST_INTERVAL > 0:
+    threading.Thread(target=run_digests, name="notification-digests", daemon=True).start()
 
 @app.route('/send-notification', methods=['POST'])
 def send_notification():
@@ -34,47 +393,89 @@ def send_notification():
         for field in required_fields:
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
+        priority = data.get('priority', 'normal')
+        if priority not in NOTIFICATION_PRIORITIES:
+            return jsonify({"error": f"priority must be one of {', '.join(NOTIFICATION_PRIORITIES)}"}), 400
+        if 'dedupe_key' in data and (not isinstance(data['dedupe_key'], str) or not data['dedupe_key']):
+            return jsonify({"error": "dedupe_key must be a non-empty string"}), 400
 
         conn = get_db_connection()
         cursor = conn.cursor()
 
         # Check if agent exists
-        cursor.execute("SELECT id FROM agents WHERE id = %s", (data['agent_id'],))
-        if cursor.fetchone() is None:
+        if not agent_directory.exists(cursor, data['agent_id']):
             return jsonify({"error": "Agent not found"}), 404
 
-        # Get notification preferences
-        cursor.execute(
-            "SELECT email_notifications, sms_notifications FROM notification_preferences WHERE agent_id = %s",
-            (data['agent_id'],)
-        )
-        prefs = cursor.fetchone()
-        
-        # Store notification in database
+        # Queue the notification; delivery workers send it. Low-priority ones
+        # wait for the next digest when digests are enabled.
         notification_type = data.get('notification_type', 'reminder')
-        cursor.execute(
-            """INSERT INTO notifications 
-            (agent_id, message, notification_type, status, sent_at) 
-            VALUES (%s, %s, %s, %s, %s) RETURNING id""",
-            (data['agent_id'], data['message'], notification_type, 'sent', datetime.utcnow())
-        )
-        notification_id = cursor.fetchone()[0]
+        delivery_methods = delivery_channels(get_preferences(cursor, data['agent_id']))
+        status = 'held' if priority == 'low' and NOTIFICATION_DIGEST_INTERVAL > 0 else 'pending'
+        params = {
+            "agent_id": data['agent_id'],
+            "message": data['message'],
+            "type": notification_type,
+            "status": status,
+            "channels": delivery_methods,
+            "priority": priority,
+            "key": None,
+            "window": NOTIFICATION_DEDUPE_WINDOW
+        }
+        if 'dedupe_key' in data and NOTIFICATION_DEDUPE_WINDOW > 0:
+            # Sends with the same key take the same advisory lock, so concurrent
+            # duplicates still collapse into one row; a repeat only updates the
+            # kept row's suppression audit. Both statements go in one round trip.
+            params["key"] = dedupe_key(data['agent_id'], data['dedupe_key'])
+            cursor.execute("""
+                SELECT pg_advisory_xact_lock(hashtext(%(key)s));
+                WITH duplicate AS (
+                    UPDATE notifications
+                    SET suppressed_count = suppressed_count + 1, last_suppressed_at = NOW()
+                    WHERE id = (
+                        SELECT id FROM notifications
+                        WHERE dedupe_key = %(key)s
+                          AND created_at > NOW() - %(window)s * INTERVAL '1 second'
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    )
+                    RETURNING id, status
+                ), inserted AS (
+                    INSERT INTO notifications
+                    (agent_id, message, notification_type, status, channels, priority, dedupe_key)
+                    SELECT %(agent_id)s, %(message)s, %(type)s, %(status)s, %(channels)s, %(priority)s, %(key)s
+                    WHERE NOT EXISTS (SELECT 1 FROM duplicate)
+                    RETURNING id, status
+                )
+                SELECT id, status, TRUE FROM duplicate
+                UNION ALL
+                SELECT id, status, FALSE FROM inserted
+            """, params)
+        else:
+            cursor.execute("""
+                INSERT INTO notifications 
+                (agent_id, message, notification_type, status, channels, priority) 
+                VALUES (%(agent_id)s, %(message)s, %(type)s, %(status)s, %(channels)s, %(priority)s)
+                RETURNING id, status, FALSE
+            """, params)
+        notification_id, status, coalesced = cursor.fetchone()
         conn.commit()
 
-        # Prepare response with delivery methods
-        delivery_methods = []
-        if prefs:
-            if prefs[0]:  # email_notifications
-                delivery_methods.append("email")
-            if prefs[1]:  # sms_notifications
-                delivery_methods.append("sms")
+        if coalesced:
+            count_coalescing("coalesced")
+            message = f"Duplicate of notification {notification_id}; not sent again"
+        elif status == 'held':
+            count_coalescing("held")
+            message = f"Notification held for the next digest to agent {data['agent_id']}"
         else:
-            # Default to email if no preferences set
-            delivery_methods.append("email")
+            count_coalescing("queued")
+            delivery_workers.wake()
+            message = f"Notification queued for agent {data['agent_id']}"
 
         return jsonify({
-            "message": f"Notification sent to agent {data['agent_id']}",
+            "message": message,
             "notification_id": notification_id,
+            "status": status,
+            "coalesced": coalesced,
             "delivery_methods": delivery_methods,
             "content": data['message']
         }), 200
@@ -84,7 +485,7 @@ def send_notification():
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 @app.route('/check-target-achievements', methods=['POST'])
 def check_target_achievements():
@@ -98,40 +499,245 @@ def check_target_achievements():
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Get agent's sales data and target threshold
-        cursor.execute("""
-            SELECT np.sales_target_threshold, COALESCE(SUM(sd.sale_amount), 0) as total_sales
-            FROM notification_preferences np
-            LEFT JOIN sales_data sd ON np.agent_id = sd.agent_id 
-                AND sd.sale_date >= DATE_TRUNC('month', CURRENT_DATE)
-            WHERE np.agent_id = %s
-            GROUP BY np.sales_target_threshold
-        """, (data['agent_id'],))
-        
-        result = cursor.fetchone()
-        if not result:
+        # Get agent's target threshold and sales data
+        prefs = get_preferences(cursor, data['agent_id'])
+        if prefs is NO_PREFERENCES or prefs['sales_target_threshold'] is None:
             return jsonify({"error": "Agent preferences not found"}), 404
+        threshold = prefs['sales_target_threshold']
 
-        threshold, total_sales = result
+        cursor.execute("""
+            SELECT COALESCE(SUM(sale_amount), 0) FROM sales_data
+            WHERE agent_id = %s AND sale_date >= DATE_TRUNC('month', CURRENT_DATE)
+        """, (data['agent_id'],))
+        total_sales = cursor.fetchone()[0]
         target_achieved = total_sales >= threshold
 
+        notification_sent = False
         if target_achieved:
-            # Send congratulatory notification
-            message = f"Congratulations! You've achieved your monthly sales target of ${threshold:.2f}"
-            cursor.execute(
-                """INSERT INTO notifications 
-                (agent_id, message, notification_type, status, sent_at) 
-                VALUES (%s, %s, 'achievement', 'sent', %s)""",
-                (data['agent_id'], message, datetime.utcnow())
-            )
+            # Send congratulatory notification, unless the tracker or an
+            # earlier check already did this month
+            notification_sent = insert_achievement(cursor, data['agent_id'], total_sales) is not None
             conn.commit()
+            if notification_sent:
+                delivery_workers.wake()
 
         return jsonify({
             "agent_id": data['agent_id'],
             "target_threshold": float(threshold),
             "current_sales": float(total_sales),
             "target_achieved": target_achieved,
-            "notification_sent": target_achieved
+            "notification_sent": notification_sent
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+@app.route('/check-target-achievements/bulk', methods=['POST'])
+def check_target_achievements_bulk():
+    conn = None
+    cursor = None
+    try:
+        data = request.get_json(silent=True) or {}
+        agent_ids = data.get('agent_ids')
+        if agent_ids is not None:
+            if not isinstance(agent_ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in agent_ids):
+                return jsonify({"error": "agent_ids must be a list of integers"}), 400
+            agent_ids = sorted(set(agent_ids))
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ACHIEVEMENT_CHECK_LOCK,))
+
+        # Evaluate every agent with a target (or the supplied ones) in one pass
+        # over this month's sales, and congratulate all that reached it with a
+        # single insert. Agents already congratulated this month are skipped
+        # before their sales are summed.
+        cursor.execute("""
+            WITH prefs AS MATERIALIZED (
+                SELECT np.agent_id, np.sales_target_threshold,
+                       EXISTS (
+                           SELECT 1 FROM notifications n
+                           WHERE n.agent_id = np.agent_id
+                             AND n.notification_type = 'achievement'
+                             AND n.created_at >= DATE_TRUNC('month', CURRENT_DATE)
+                       ) AS notified
+                FROM notification_preferences np
+                WHERE np.sales_target_threshold IS NOT NULL
+                  AND (%(all)s OR np.agent_id = ANY(%(agent_ids)s))
+            ), month_sales AS (
+                SELECT sd.agent_id, SUM(sd.sale_amount) AS total_sales
+                FROM sales_data sd
+                JOIN prefs p ON p.agent_id = sd.agent_id AND NOT p.notified
+                WHERE sd.sale_date >= DATE_TRUNC('month', CURRENT_DATE)
+                GROUP BY sd.agent_id
+            ), achieved AS (
+                SELECT p.agent_id, p.sales_target_threshold, COALESCE(ms.total_sales, 0) AS total_sales
+                FROM prefs p
+                LEFT JOIN month_sales ms ON ms.agent_id = p.agent_id
+                WHERE NOT p.notified AND COALESCE(ms.total_sales, 0) >= p.sales_target_threshold
+            ), inserted AS (
+                INSERT INTO notifications (agent_id, message, notification_type, status)
+                SELECT agent_id,
+                       'Congratulations! You''ve achieved your monthly sales target of $'
+                           || ROUND(sales_target_threshold, 2)::text,
+                       'achievement', 'pending'
+                FROM achieved
+                RETURNING id, agent_id
+            )
+            SELECT p.agent_id, p.notified, a.sales_target_threshold, a.total_sales, i.id
+            FROM prefs p
+            LEFT JOIN achieved a ON a.agent_id = p.agent_id
+            LEFT JOIN inserted i ON i.agent_id = p.agent_id
+            ORDER BY p.agent_id
+        """, {"all": agent_ids is None, "agent_ids": agent_ids or []})
+        rows = cursor.fetchall()
+        conn.commit()
+        delivery_workers.wake()
+
+        achievements = [{
+            "agent_id": r[0],
+            "target_threshold": float(r[2]),
+            "current_sales": float(r[3]),
+            "notification_id": r[4]
+        } for r in rows if r[4] is not None]
+        response = {
+            "evaluated": len(rows),
+            "already_notified": sum(1 for r in rows if r[1]),
+            "notifications_sent": len(achievements),
+            "achievements": achievements
+        }
+        if agent_ids is not None:
+            found = {r[0] for r in rows}
+            response["without_target"] = [i for i in agent_ids if i not in found]
+        return jsonify(response), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# CREATE - Broadcast to a branch, a product's agents or everyone
+@app.route('/broadcasts', methods=['POST'])
+def create_broadcast():
+    conn = None
+    cursor = None
+    try:
+        data = request.get_json()
+        if 'message' not in data:
+            return jsonify({"error": "Missing required field: message"}), 400
+        targets = [key for key in ('branch_id', 'product', 'all') if key in data]
+        if len(targets) != 1:
+            return jsonify({"error": "Provide exactly one of branch_id, product or all"}), 400
+        target = targets[0]
+        if target == 'branch_id':
+            if not isinstance(data['branch_id'], int) or isinstance(data['branch_id'], bool):
+                return jsonify({"error": "branch_id must be an integer"}), 400
+            target_value = data['branch_id']
+            where, target_param = "a.branch_id = %(target)s", data['branch_id']
+        elif target == 'product':
+            # Matches idx_agents_products_gin (migrations/001_agents_products_gin.sql)
+            target_value = data['product']
+            where, target_param = "a.products::jsonb @> %(target)s::jsonb", json.dumps([data['product']])
+        else:
+            if data['all'] is not True:
+                return jsonify({"error": "all must be true"}), 400
+            target_value = None
+            where, target_param = "TRUE", None
+        notification_type = data.get('notification_type', 'broadcast')
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Recipients and their delivery channels are materialised in one
+        # INSERT ... SELECT, the same resolution send-notification applies
+        cursor.execute(f"""
+            WITH broadcast AS (
+                INSERT INTO notification_broadcasts (target_type, target_value, message, notification_type)
+                VALUES (%(target_type)s, %(target_value)s, %(message)s, %(type)s)
+                RETURNING id
+            ), inserted AS (
+                INSERT INTO notifications (agent_id, message, notification_type, status, channels, broadcast_id)
+                SELECT a.id, %(message)s, %(type)s, 'pending',
+                       CASE WHEN np.agent_id IS NULL THEN ARRAY['email']
+                            ELSE ARRAY_REMOVE(ARRAY[
+                                CASE WHEN np.email_notifications THEN 'email' END,
+                                CASE WHEN np.sms_notifications THEN 'sms' END
+                            ], NULL)
+                       END,
+                       b.id
+                FROM agents a
+                CROSS JOIN broadcast b
+                LEFT JOIN notification_preferences np ON np.agent_id = a.id
+                WHERE {where}
+                RETURNING channels
+            )
+            SELECT (SELECT id FROM broadcast),
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE 'email' = ANY(channels)),
+                   COUNT(*) FILTER (WHERE 'sms' = ANY(channels)),
+                   COUNT(*) FILTER (WHERE CARDINALITY(channels) = 0)
+            FROM inserted
+        """, {
+            "target_type": target,
+            "target_value": None if target_value is None else str(target_value),
+            "message": data['message'],
+            "type": notification_type,
+            "target": target_param
+        })
+        broadcast_id, recipients, email, sms, no_channel = cursor.fetchone()
+        cursor.execute("UPDATE notification_broadcasts SET recipients = %s WHERE id = %s", (recipients, broadcast_id))
+        conn.commit()
+        delivery_workers.wake()
+
+        return jsonify({
+            "broadcast_id": broadcast_id,
+            "target": {target: target_value} if target_value is not None else {"all": True},
+            "recipients": recipients,
+            "delivery_methods": {"email": email, "sms": sms, "none": no_channel}
+        }), 201
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# READ - Broadcast delivery progress
+@app.route('/broadcasts/<int:broadcast_id>', methods=['GET'])
+def get_broadcast(broadcast_id):
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT target_type, target_value, message, notification_type, recipients, created_at
+            FROM notification_broadcasts WHERE id = %s
+        """, (broadcast_id,))
+        broadcast = cursor.fetchone()
+        if broadcast is None:
+            return jsonify({"error": "Broadcast not found"}), 404
+
+        cursor.execute(
+            "SELECT status, COUNT(*) FROM notifications WHERE broadcast_id = %s GROUP BY status",
+            (broadcast_id,)
+        )
+        return jsonify({
+            "broadcast_id": broadcast_id,
+            "target_type": broadcast[0],
+            "target_value": broadcast[1],
+            "message": broadcast[2],
+            "notification_type": broadcast[3],
+            "recipients": broadcast[4],
+            "created_at": broadcast[5].isoformat(),
+            "status": dict(cursor.fetchall())
         }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -139,7 +745,7 @@ def check_target_achievements():
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
 @app.route('/notification-preferences/<int:agent_id>', methods=['GET', 'PUT'])
 def handle_preferences(agent_id):
@@ -150,58 +756,35 @@ def handle_preferences(agent_id):
         cursor = conn.cursor()
 
         # Check if agent exists
-        cursor.execute("SELECT id FROM agents WHERE id = %s", (agent_id,))
-        if cursor.fetchone() is None:
+        if not agent_directory.exists(cursor, agent_id):
             return jsonify({"error": "Agent not found"}), 404
 
         if request.method == 'GET':
-            cursor.execute(
-                "SELECT email_notifications, sms_notifications, push_notifications, sales_target_threshold FROM notification_preferences WHERE agent_id = %s",
-                (agent_id,)
-            )
-            prefs = cursor.fetchone()
-            if not prefs:
+            prefs = get_preferences(cursor, agent_id)
+            if prefs is NO_PREFERENCES:
                 return jsonify({"message": "Using default notification preferences"}), 200
 
-            return jsonify({
-                "email_notifications": prefs[0],
-                "sms_notifications": prefs[1],
-                "push_notifications": prefs[2],
-                "sales_target_threshold": float(prefs[3])
-            }), 200
+            return jsonify(dict(prefs, sales_target_threshold=float(prefs['sales_target_threshold']))), 200
 
         elif request.method == 'PUT':
             data = request.get_json()
-            update_fields = []
-            update_values = []
-            valid_fields = ['email_notifications', 'sms_notifications', 
-                           'push_notifications', 'sales_target_threshold']
-
-            for field in valid_fields:
-                if field in data:
-                    update_fields.append(f"{field} = %s")
-                    update_values.append(data[field])
-
-            if not update_fields:
+            fields = [field for field in PREFERENCE_FIELDS if field in data]
+            if not fields:
                 return jsonify({"error": "No valid fields provided for update"}), 400
 
-            # Check if preferences exist
-            cursor.execute("SELECT 1 FROM notification_preferences WHERE agent_id = %s", (agent_id,))
-            if cursor.fetchone():
-                # Update existing preferences
-                update_query = f"UPDATE notification_preferences SET {', '.join(update_fields)} WHERE agent_id = %s"
-                update_values.append(agent_id)
-            else:
-                # Insert new preferences
-                update_query = f"""
-                    INSERT INTO notification_preferences 
-                    (agent_id, {', '.join(field.split(' = ')[0] for field in update_fields)}) 
-                    VALUES (%s, {', '.join(['%s']*len(update_fields))}
-                """
-                update_values.insert(0, agent_id)
-
-            cursor.execute(update_query, update_values)
+            # Create or update the preferences in one statement
+            cursor.execute(f"""
+                INSERT INTO notification_preferences (agent_id, {', '.join(fields)})
+                VALUES (%s, {', '.join(['%s'] * len(fields))})
+                ON CONFLICT (agent_id) DO UPDATE
+                SET {', '.join(f"{field} = EXCLUDED.{field}" for field in fields)}
+                RETURNING {', '.join(PREFERENCE_FIELDS)}
+            """, [agent_id] + [data[field] for field in fields])
+            prefs = dict(zip(PREFERENCE_FIELDS, cursor.fetchone()))
             conn.commit()
+            preferences_cache.invalidate(agent_id)
+            preferences_cache.set(agent_id, prefs)
+            target_tracker.set_threshold(agent_id, prefs['sales_target_threshold'])
 
             return jsonify({"message": "Notification preferences updated"}), 200
 
@@ -211,50 +794,233 @@ def handle_preferences(agent_id):
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# READ - Notification inbox
+NOTIFICATIONS_PAGE_DEFAULT = 50
+NOTIFICATIONS_PAGE_MAX = 200
+
+def notification_row_to_dict(note):
+    return {
+        "id": note[0],
+        "message": note[1],
+        "type": note[2],
+        "status": note[3],
+        "created_at": note[4].isoformat() if note[4] else None,
+        "sent_at": note[5].isoformat() if note[5] else None,
+        "read_at": note[6].isoformat() if note[6] else None
+    }
+
+def parse_since(since):
+    # "<txid>", "<txid>:<id>" or "<txid>:<id>:<txid>:<id>", as returned in
+    # X-Changes-Since. The first pair is the point it is safe to resume from;
+    # the optional second pair is how far a batch that did not fit in one page
+    # has been read.
+    parts = [int(part) for part in since.split(":")]
+    if len(parts) not in (1, 2, 4):
+        raise ValueError("since must be <txid>, <txid>:<id> or <txid>:<id>:<txid>:<id>")
+    resume = (parts[0], parts[1] if len(parts) > 1 else 0)
+    after = (parts[2], parts[3]) if len(parts) == 4 else None
+    return resume, after
 
 @app.route('/notifications/<int:agent_id>', methods=['GET'])
 def get_notifications(agent_id):
     conn = None
     cursor = None
     try:
+        limit = int(request.args.get("limit", NOTIFICATIONS_PAGE_DEFAULT))
+        if not 1 <= limit <= NOTIFICATIONS_PAGE_MAX:
+            return jsonify({"error": f"limit must be between 1 and {NOTIFICATIONS_PAGE_MAX}"}), 400
+        since = request.args.get("since")
+        if since is not None:
+            since, after = parse_since(since)
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
         # Check if agent exists
-        cursor.execute("SELECT id FROM agents WHERE id = %s", (agent_id,))
-        if cursor.fetchone() is None:
+        if not agent_directory.exists(cursor, agent_id):
             return jsonify({"error": "Agent not found"}), 404
 
-        # Get notifications
+        # Anything that commits after this point has a txid of at least xmin
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        horizon = cursor.fetchone()[0]
+
+        columns = "id, message, notification_type, status, created_at, sent_at, read_at, change_txid"
+        if since is not None:
+            # Poll mode: only rows inserted or updated since the last poll,
+            # oldest change first (idx_notifications_agent_change)
+            position = max(since, after) if after else since
+            cursor.execute(f"""
+                SELECT {columns} FROM notifications
+                WHERE agent_id = %s AND (change_txid, id) > (%s, %s)
+                ORDER BY change_txid, id
+                LIMIT %s
+            """, (agent_id, position[0], position[1], limit))
+            rows = cursor.fetchall()
+            # Everything below the horizon is committed, so the resume point
+            # may move up to the horizon once every row before it was returned.
+            # A full page may not have reached it yet: the resume point then
+            # stops at the last row (or the horizon, if lower) and the token
+            # also carries the last row, to read the rest of the batch from.
+            # Rows past the resume point may be returned again on a later poll
+            # (clients key them by id), but the poll never stalls on a page.
+            if len(rows) == limit:
+                last = (rows[-1][7], rows[-1][0])
+                resume = max(since, min(last, (horizon, 0)))
+                next_since = "%d:%d" % resume if resume == last else "%d:%d:%d:%d" % (resume + last)
+            else:
+                next_since = "%d:%d" % max(since, (horizon, 0))
+        else:
+            # Newest first, keyset paged on (created_at, id) (idx_notifications_agent_created)
+            where = "agent_id = %s"
+            params = [agent_id]
+            if request.args.get("unread", "false").lower() == "true":
+                where += " AND read_at IS NULL"
+            if request.args.get("before_created_at") or request.args.get("before_id"):
+                if not (request.args.get("before_created_at") and request.args.get("before_id")):
+                    return jsonify({"error": "before_created_at and before_id must be given together"}), 400
+                where += " AND (created_at, id) < (%s, %s)"
+                params += [request.args["before_created_at"], int(request.args["before_id"])]
+            cursor.execute(f"""
+                SELECT {columns} FROM notifications
+                WHERE {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, params + [limit])
+            rows = cursor.fetchall()
+            next_since = str(horizon)
+
+        response = jsonify([notification_row_to_dict(row) for row in rows])
+        # Clients poll with ?since=<X-Changes-Since> to get only what changed
+        response.headers["X-Changes-Since"] = next_since
+        # A full page means there may be more; clients pass these back as before_created_at/before_id
+        if since is None and len(rows) == limit:
+            response.headers["X-Next-Before-Created-At"] = rows[-1][4].isoformat()
+            response.headers["X-Next-Before-Id"] = str(rows[-1][0])
+        return response, 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+@app.route('/notifications/<int:agent_id>/unread-count', methods=['GET'])
+def get_unread_count(agent_id):
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Check if agent exists
+        if not agent_directory.exists(cursor, agent_id):
+            return jsonify({"error": "Agent not found"}), 404
+
+        # Counted from idx_notifications_agent_unread, a partial index of unread rows
+        cursor.execute("SELECT COUNT(*) FROM notifications WHERE agent_id = %s AND read_at IS NULL", (agent_id,))
+        return jsonify({"agent_id": agent_id, "unread": cursor.fetchone()[0]}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# UPDATE - Mark notifications read
+@app.route('/notifications/<int:agent_id>/read', methods=['POST'])
+def mark_notifications_read(agent_id):
+    conn = None
+    cursor = None
+    try:
+        data = request.get_json()
+        ids = data.get('ids')
+        mark_all = data.get('all') is True
+        if mark_all == (ids is not None):
+            return jsonify({"error": "Provide either ids or all: true"}), 400
+        if not mark_all and (not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+            return jsonify({"error": "ids must be a list of integers"}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Check if agent exists
+        if not agent_directory.exists(cursor, agent_id):
+            return jsonify({"error": "Agent not found"}), 404
+
+        where = "agent_id = %s AND read_at IS NULL"
+        params = [datetime.utcnow(), agent_id]
+        if not mark_all:
+            where += " AND id = ANY(%s)"
+            params.append(ids)
+        cursor.execute(f"UPDATE notifications SET read_at = %s WHERE {where}", params)
+        marked = cursor.rowcount
+        conn.commit()
+
+        return jsonify({"agent_id": agent_id, "marked_read": marked}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            db_pool.putconn(conn)
+
+# METRICS - Connection pool usage and wait times
+@app.route('/metrics/db-pool', methods=['GET'])
+def db_pool_metrics():
+    return jsonify(db_pool.stats()), 200
+
+# METRICS - In-memory agent directory
+@app.route('/metrics/agent-directory', methods=['GET'])
+def agent_directory_metrics():
+    return jsonify(agent_directory.stats()), 200
+
+# METRICS - Notification preferences cache
+@app.route('/metrics/preferences-cache', methods=['GET'])
+def preferences_cache_metrics():
+    return jsonify(preferences_cache.stats()), 200
+
+# METRICS - Coalescing and digests
+@app.route('/metrics/coalescing', methods=['GET'])
+def coalescing_metrics():
+    with coalescing_lock:
+        stats = dict(coalescing_stats)
+    stats.update({
+        "dedupe_window": NOTIFICATION_DEDUPE_WINDOW,
+        "digest_interval": NOTIFICATION_DIGEST_INTERVAL
+    })
+    return jsonify(stats), 200
+
+# METRICS - Outbox delivery workers
+@app.route('/metrics/delivery', methods=['GET'])
+def delivery_metrics():
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, message, notification_type, status, created_at, sent_at, read_at
-            FROM notifications
-            WHERE agent_id = %s
-            ORDER BY created_at DESC
-            LIMIT 50
-        """, (agent_id,))
-        
-        notifications = []
-        for note in cursor.fetchall():
-            notifications.append({
-                "id": note[0],
-                "message": note[1],
-                "type": note[2],
-                "status": note[3],
-                "created_at": note[4].isoformat() if note[4] else None,
-                "sent_at": note[5].isoformat() if note[5] else None,
-                "read_at": note[6].isoformat() if note[6] else None
-            })
-
-        return jsonify(notifications), 200
+            SELECT status, COUNT(*), MIN(created_at) FROM notifications
+            WHERE status IN ('pending', 'sending') GROUP BY status
+        """)
+        outbox = {r[0]: {"count": r[1], "oldest": r[2].isoformat()} for r in cursor.fetchall()}
+        return jsonify(dict(delivery_workers.stats(), outbox=outbox)), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     finally:
         if cursor is not None:
             cursor.close()
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
+
+# METRICS - Running monthly totals and the sales feed behind them
+@app.route('/metrics/target-tracker', methods=['GET'])
+def target_tracker_metrics():
+    return jsonify(dict(target_tracker.stats(), feed=sales_feed.stats())), 200
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8083)
@@ -0,0 +1,108 @@
+# stub_servers.py
+# Local stand-ins for the email and SMS providers, for development and
+# testing of notification delivery: an SMTP server on STUB_SMTP_PORT and an
+# HTTP SMS gateway on STUB_SMS_PORT that accept and print every message.
+# STUB_FAIL_RATE (0-1) makes that share of deliveries fail, to exercise retries.
+import json
+import os
+import random
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_SMTP_PORT = int(os.environ.get("STUB_SMTP_PORT", 1025))
+STUB_SMS_PORT = int(os.environ.get("STUB_SMS_PORT", 8099))
+STUB_FAIL_RATE = float(os.environ.get("STUB_FAIL_RATE", 0))
+
+received = {"email": 0, "sms": 0}
+received_lock = threading.Lock()
+
+
+def count(channel):
+    with received_lock:
+        received[channel] += 1
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        self.reply("220 stub-smtp ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 stub-smtp")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                body = []
+                for data in iter(self.rfile.readline, b""):
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    body.append(data.decode("utf-8", "replace"))
+                if random.random() < STUB_FAIL_RATE:
+                    self.reply("451 Simulated temporary failure")
+                    continue
+                count("email")
+                print(f"[smtp] to {', '.join(recipients)}: {len(body)} line(s)", flush=True)
+                self.reply("250 OK")
+            elif verb == "RSET" or verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SmsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if random.random() < STUB_FAIL_RATE:
+            self.send_response(503)
+            self.end_headers()
+            return
+        message = json.loads(body)
+        count("sms")
+        print(f"[sms] to agent {message.get('agent_id')}: {message.get('message')}", flush=True)
+        self.send_response(202)
+        self.end_headers()
+
+    def do_GET(self):
+        # Received message counts, for tests
+        with received_lock:
+            body = json.dumps(received).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    smtp = ThreadingTCPServer(("0.0.0.0", STUB_SMTP_PORT), SmtpHandler)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    print(f"Stub SMTP server on port {STUB_SMTP_PORT}, stub SMS gateway on port {STUB_SMS_PORT}", flush=True)
+    ThreadingHTTPServer(("0.0.0.0", STUB_SMS_PORT), SmsHandler).serve_forever()
+
+if __name__ == "__main__":
+    main()
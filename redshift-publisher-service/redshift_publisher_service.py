@@ -1,49 +1,410 @@
+import csv
+import glob
+import gzip
+import io
 import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
 
+import boto3
 import psycopg2
 import redshift_connector
-import os
 
-def sync_to_redshift():
-    try:
-        print("Connecting to Postgres...")
-        pg_conn = psycopg2.connect(
-            host=os.getenv("PG_HOST", "ls-1da58d02ca2520ec50e600aa762e63871c25220d.c5g2628m27rg.ap-south-1.rds.amazonaws.com"),
-            dbname=os.getenv("PG_DB", "moon-agent"),
-            user=os.getenv("PG_USER", "moonagentuser"),
-            password=os.getenv("PG_PASSWORD", "DWIJRwybuh038&$")
+PG_CONFIG = {
+    "host": os.getenv("PG_HOST", "ls-1da58d02ca2520ec50e600aa762e63871c25220d.c5g2628m27rg.ap-south-1.rds.amazonaws.com"),
+    "dbname": os.getenv("PG_DB", "moon-agent"),
+    "user": os.getenv("PG_USER", "moonagentuser"),
+    "password": os.getenv("PG_PASSWORD", "DWIJRwybuh038&$")
+}
+
+# "redshift", or "postgres" to load a local Postgres stand-in (TARGET_PG_*)
+SYNC_TARGET = os.getenv("SYNC_TARGET", "redshift")
+SYNC_STAGE_DIR = os.getenv("SYNC_STAGE_DIR", "/tmp/redshift-sync")
+SYNC_S3_BUCKET = os.getenv("SYNC_S3_BUCKET")
+SYNC_S3_PREFIX = os.getenv("SYNC_S3_PREFIX", "redshift-sync")
+REDSHIFT_IAM_ROLE = os.getenv("REDSHIFT_IAM_ROLE")
+
+# Full export mode (python redshift_publisher_service.py export <table>)
+EXPORT_DIR = os.getenv("EXPORT_DIR", "/tmp/redshift-export")
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", 4))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 250000))
+EXPORT_FILE_MB = int(os.getenv("EXPORT_FILE_MB", 64))
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 10000))
+
+# Source table -> target table, with source column (or expression) -> target
+# column. Rows are merged into the target on id.
+SYNC_TABLES = [
+    {
+        "source": "agents",
+        "target": "agents",
+        "columns": [("id", "id"), ("name", "name"), ("code", "code"), ("details", "details"),
+                    ("products", "products"), ("branch_id", "branch_id")]
+    },
+    {
+        "source": "sales_data",
+        "target": "sales_data",
+        "columns": [("id", "id"), ("agent_id", "agent_id"), ("sale_amount", "sale_amount"),
+                    ("product_code", "product_code"), ("sale_date", "sale_date"),
+                    ("additional_details", "additional_details"), ("created_at", "created_at")]
+    },
+    {
+        "source": "performance_reports",
+        "target": "performance_reports",
+        "columns": [("id", "id"), ("report_date", "report_date"), ("report_type", "frequency"),
+                    ("data", "report_data"), ("created_at", "created_at")]
+    },
+]
+
+# Staged files are CSV with \N for NULL, which both targets' COPY accept
+CSV_NULL = "\\N"
+
+
+class PostgresTarget:
+    # A local Postgres database standing in for Redshift, for testing
+    def __init__(self):
+        self.conn = psycopg2.connect(
+            host=os.getenv("TARGET_PG_HOST", "localhost"),
+            dbname=os.getenv("TARGET_PG_DB", "moon-agent-warehouse"),
+            user=os.getenv("TARGET_PG_USER", "admin"),
+            password=os.getenv("TARGET_PG_PASSWORD", "password"),
+            port=int(os.getenv("TARGET_PG_PORT", 5432))
         )
-        pg_cur = pg_conn.cursor()
-        pg_cur.execute("SELECT * FROM performance_reports ORDER BY created_at DESC LIMIT 1")
-        row = pg_cur.fetchone()
-        row = list(row)
-        if isinstance(row[3], dict):
-            row[3] = json.dumps(row[3])
-
-        if not row:
-            print("No data to sync.")
-            return
-
-        print("Connecting to Redshift...")
-        rs_conn = redshift_connector.connect(
+
+    def load(self, cursor, stage, columns, path):
+        with gzip.open(path, "rb") as f:
+            cursor.copy_expert(
+                f"COPY {stage} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{CSV_NULL}')", f)
+
+    def cleanup(self, path):
+        os.remove(path)
+
+
+class RedshiftTarget:
+    # Files are staged in S3 and loaded with COPY, Redshift's bulk load path
+    def __init__(self):
+        if not SYNC_S3_BUCKET or not REDSHIFT_IAM_ROLE:
+            raise RuntimeError("SYNC_S3_BUCKET and REDSHIFT_IAM_ROLE are required for the Redshift target")
+        self.conn = redshift_connector.connect(
             host=os.getenv("REDSHIFT_HOST", "kce-cluster.cd9fbf7fnazh.ap-south-1.redshift.amazonaws.com"),
             database=os.getenv("REDSHIFT_DB", "moon-agent"),
             user=os.getenv("REDSHIFT_USER", "awsuser"),
             password=os.getenv("REDSHIFT_PASSWORD", "DWIJRwybuh038&$")
         )
-        rs_cur = rs_conn.cursor()
+        self.s3 = boto3.client("s3")
+
+    def _key(self, path):
+        return f"{SYNC_S3_PREFIX}/{os.path.basename(path)}"
+
+    def load(self, cursor, stage, columns, path):
+        self.s3.upload_file(path, SYNC_S3_BUCKET, self._key(path))
+        cursor.execute(f"""
+            COPY {stage} ({', '.join(columns)})
+            FROM 's3://{SYNC_S3_BUCKET}/{self._key(path)}'
+            IAM_ROLE '{REDSHIFT_IAM_ROLE}'
+            FORMAT CSV GZIP NULL AS '{CSV_NULL}'
+            DATEFORMAT 'auto' TIMEFORMAT 'auto'
+        """)
+
+    def cleanup(self, path):
+        self.s3.delete_object(Bucket=SYNC_S3_BUCKET, Key=self._key(path))
+        os.remove(path)
+
+
+def connect_target():
+    if SYNC_TARGET == "postgres":
+        return PostgresTarget()
+    if SYNC_TARGET == "redshift":
+        return RedshiftTarget()
+    raise ValueError(f"unknown SYNC_TARGET {SYNC_TARGET!r}")
+
+def read_watermarks(target):
+    # Watermarks live in the target and move in the same transaction as the
+    # rows they cover, so a failed load is simply retried from the old one
+    cursor = target.conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_watermarks (
+            table_name VARCHAR(128) NOT NULL,
+            watermark BIGINT NOT NULL,
+            rows_synced BIGINT NOT NULL,
+            synced_at TIMESTAMP NOT NULL
+        )
+    """)
+    cursor.execute("SELECT table_name, watermark FROM sync_watermarks")
+    watermarks = dict(cursor.fetchall())
+    target.conn.commit()
+    return watermarks
+
+def select_list(table):
+    return ", ".join(f"{source}::text" if source in ("data", "additional_details") else source
+                     for source, _ in table["columns"])
+
+def export_table(pg_cur, table, watermark, path, deletes_path):
+    # Changed rows only (migrations/013_sync_change_txid.sql), plus the ids
+    # deleted since; a table without a watermark is exported in full
+    columns = select_list(table)
+    where = "TRUE" if watermark is None else pg_cur.mogrify("change_txid >= %s", (watermark,)).decode()
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        pg_cur.copy_expert(
+            f"COPY (SELECT {columns} FROM {table['source']} WHERE {where}) "
+            f"TO STDOUT WITH (FORMAT csv, NULL '{CSV_NULL}')", f)
+    rows = pg_cur.rowcount
+    with gzip.open(deletes_path, "wb", compresslevel=6) as f:
+        pg_cur.copy_expert(
+            "COPY (SELECT DISTINCT id FROM sync_tombstones WHERE "
+            + pg_cur.mogrify("table_name = %s", (table["source"],)).decode() + f" AND {where}) "
+            f"TO STDOUT WITH (FORMAT csv, NULL '{CSV_NULL}')", f)
+    return rows, pg_cur.rowcount
 
-        # Update with your actual columns
-        rs_cur.execute("""
-                INSERT INTO performance_reports (id, report_date, frequency, report_data, created_at)
-                VALUES (%s, %s, %s, %s, %s)
-            """, row)
-        rs_conn.commit()
+def merge_table(target, table, path, rows, deletes_path, deletes, watermark):
+    # Upsert: load the file into a temporary stage, then replace matching ids;
+    # deleted ids are loaded the same way and removed
+    stage = f"stage_{table['target']}"
+    deleted = f"deleted_{table['target']}"
+    columns = [column for _, column in table["columns"]]
+    cursor = target.conn.cursor()
+    try:
+        if rows:
+            cursor.execute(f"CREATE TEMP TABLE {stage} (LIKE {table['target']})")
+            target.load(cursor, stage, columns, path)
+            cursor.execute(f"DELETE FROM {table['target']} USING {stage} WHERE {table['target']}.id = {stage}.id")
+            cursor.execute(f"""
+                INSERT INTO {table['target']} ({', '.join(columns)})
+                SELECT {', '.join(columns)} FROM {stage}
+            """)
+            cursor.execute(f"DROP TABLE {stage}")
+        if deletes:
+            cursor.execute(f"CREATE TEMP TABLE {deleted} (id INTEGER)")
+            target.load(cursor, deleted, ["id"], deletes_path)
+            cursor.execute(f"DELETE FROM {table['target']} USING {deleted} WHERE {table['target']}.id = {deleted}.id")
+            cursor.execute(f"DROP TABLE {deleted}")
+        cursor.execute("DELETE FROM sync_watermarks WHERE table_name = %s", (table["source"],))
+        cursor.execute(
+            "INSERT INTO sync_watermarks (table_name, watermark, rows_synced, synced_at) VALUES (%s, %s, %s, %s)",
+            (table["source"], watermark, rows, datetime.utcnow()))
+        target.conn.commit()
+    except Exception:
+        target.conn.rollback()
+        raise
+
+def prune_tombstones(watermarks):
+    # Tombstones below a committed watermark are never read again
+    conn = psycopg2.connect(**PG_CONFIG)
+    try:
+        cursor = conn.cursor()
+        for table_name, watermark in watermarks.items():
+            cursor.execute("DELETE FROM sync_tombstones WHERE table_name = %s AND change_txid < %s",
+                           (table_name, watermark))
+        conn.commit()
+    finally:
+        conn.close()
+
+def sync_to_redshift():
+    run_id = uuid.uuid4().hex[:12]
+    os.makedirs(SYNC_STAGE_DIR, exist_ok=True)
+    pg_conn = None
+    target = None
+    staged = []
+    exports = []
+    try:
+        print(f"Connecting to {SYNC_TARGET} target...")
+        target = connect_target()
+        watermarks = read_watermarks(target)
 
+        print("Connecting to Postgres...")
+        pg_conn = psycopg2.connect(**PG_CONFIG)
+        pg_conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        pg_cur = pg_conn.cursor()
+        # Every table is read from this one snapshot. Anything that commits
+        # after it has a txid of at least its xmin, which becomes the next
+        # watermark; rows at or above it may be sent twice, never missed.
+        pg_cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        horizon = pg_cur.fetchone()[0]
+        for table in SYNC_TABLES:
+            started = time.monotonic()
+            path = os.path.join(SYNC_STAGE_DIR, f"{table['source']}-{run_id}.csv.gz")
+            deletes_path = os.path.join(SYNC_STAGE_DIR, f"{table['source']}-{run_id}-deleted.csv.gz")
+            staged += [path, deletes_path]
+            rows, deletes = export_table(pg_cur, table, watermarks.get(table["source"]), path, deletes_path)
+            exports.append((table, path, deletes_path, rows, deletes, time.monotonic() - started))
+        # Everything is staged; the snapshot is not held through the uploads
+        # and loads, where it would hold back vacuum on the source
+        pg_conn.close()
+        pg_conn = None
+
+        for table, path, deletes_path, rows, deletes, elapsed in exports:
+            started = time.monotonic()
+            merge_table(target, table, path, rows, deletes_path, deletes, horizon)
+            watermark = watermarks.get(table["source"])
+            mode = "full" if watermark is None else f"since txid {watermark}"
+            print(f"  {table['source']}: {rows} row(s), {deletes} delete(s) ({mode}), "
+                  f"exported in {elapsed:.3f}s, loaded in {time.monotonic() - started:.3f}s")
+
+        prune_tombstones({table["source"]: horizon for table in SYNC_TABLES})
         print("✅ Sync successful!")
     except Exception as e:
         print("❌ Sync failed:", str(e))
         raise
+    finally:
+        if pg_conn is not None:
+            pg_conn.close()
+        if target is not None:
+            for path in staged:
+                if os.path.exists(path):
+                    target.cleanup(path)
+            target.conn.close()
+
+# EXPORT - Full resync of one table as id-range chunks, exported in parallel
+# to gzip-CSV files. manifest.json records the plan and every finished chunk,
+# so a rerun with the same EXPORT_DIR only exports what is missing.
+def write_manifest(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def plan_export(table, out_dir):
+    path = os.path.join(out_dir, "manifest.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest["columns"] != [column for _, column in table["columns"]]:
+            raise RuntimeError(f"{path} was written for different columns; use a new EXPORT_DIR")
+        return path, manifest
+
+    conn = psycopg2.connect(**PG_CONFIG)
+    try:
+        cursor = conn.cursor()
+        # Rows changed after this point are left to the incremental sync,
+        # which can start from the recorded watermark
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        watermark = cursor.fetchone()[0]
+        # Chunk boundaries are found by stepping through the primary key
+        # index, so chunks hold EXPORT_CHUNK_ROWS rows however sparse ids are
+        chunks = []
+        cursor.execute(f"SELECT MIN(id) FROM {table['source']}")
+        start = cursor.fetchone()[0]
+        while start is not None:
+            cursor.execute(f"SELECT id FROM {table['source']} WHERE id >= %s ORDER BY id OFFSET %s LIMIT 1",
+                           (start, EXPORT_CHUNK_ROWS))
+            row = cursor.fetchone()
+            end = row[0] if row else None
+            chunks.append({"chunk": len(chunks), "from_id": start, "to_id": end})
+            start = end
+    finally:
+        conn.close()
+
+    manifest = {
+        "table": table["source"],
+        "target": table["target"],
+        "columns": [column for _, column in table["columns"]],
+        "watermark": watermark,
+        "created_at": datetime.utcnow().isoformat(),
+        "chunks": chunks,
+        "completed": {}
+    }
+    write_manifest(path, manifest)
+    return path, manifest
+
+def export_chunk(table, chunk, out_dir):
+    # Runs in a worker process with its own connection. Files of a chunk that
+    # was interrupted are overwritten; the chunk only counts once the parent
+    # records it in the manifest.
+    prefix = os.path.join(out_dir, f"chunk-{chunk['chunk']:06d}")
+    for stale in glob.glob(prefix + "-*.csv.gz"):
+        os.remove(stale)
+
+    conn = psycopg2.connect(**PG_CONFIG)
+    files = []
+    raw = out = None
+    try:
+        conn.set_session(readonly=True)
+        cursor = conn.cursor(name=f"export_{table['source']}_{chunk['chunk']}")
+        cursor.itersize = EXPORT_FETCH_SIZE
+        cursor.execute(f"""
+            SELECT {select_list(table)} FROM {table['source']}
+            WHERE id >= %s AND (%s IS NULL OR id < %s)
+            ORDER BY id
+        """, (chunk["from_id"], chunk["to_id"], chunk["to_id"]))
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            if out is None:
+                path = f"{prefix}-{len(files):03d}.csv.gz"
+                raw = open(path, "wb")
+                out = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6),
+                                       encoding="utf-8", newline="")
+                writer = csv.writer(out)
+                files.append({"path": os.path.basename(path), "rows": 0})
+            writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+            files[-1]["rows"] += len(rows)
+            # raw.tell() trails the compressor's buffer, which is close enough
+            # for a size target
+            if raw.tell() >= EXPORT_FILE_MB * 1024 * 1024:
+                out.close()
+                files[-1]["bytes"] = raw.tell()
+                raw.close()
+                raw = out = None
+        if out is not None:
+            out.close()
+            files[-1]["bytes"] = raw.tell()
+            raw.close()
+            raw = out = None
+        cursor.close()
+        conn.commit()
+    finally:
+        if raw is not None:
+            raw.close()
+        conn.close()
+    return {"rows": sum(f["rows"] for f in files), "files": files}
+
+def export_full(table_name):
+    try:
+        table = next((t for t in SYNC_TABLES if t["source"] == table_name), None)
+        if table is None:
+            raise ValueError(f"unknown table {table_name!r}; expected one of {[t['source'] for t in SYNC_TABLES]}")
+        out_dir = os.path.join(EXPORT_DIR, table["source"])
+        os.makedirs(out_dir, exist_ok=True)
+        manifest_path, manifest = plan_export(table, out_dir)
+        pending = [c for c in manifest["chunks"] if str(c["chunk"]) not in manifest["completed"]]
+        print(f"Exporting {table['source']}: {len(manifest['chunks'])} chunk(s), "
+              f"{len(manifest['chunks']) - len(pending)} already done, {EXPORT_WORKERS} worker(s)")
+
+        started = time.monotonic()
+        rows = 0
+        failed = 0
+        with ProcessPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+            futures = {executor.submit(export_chunk, table, chunk, out_dir): chunk for chunk in pending}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Keep recording the other chunks; a rerun retries this one
+                    failed += 1
+                    print(f"  chunk {chunk['chunk']} failed: {e}")
+                    continue
+                manifest["completed"][str(chunk["chunk"])] = result
+                write_manifest(manifest_path, manifest)
+                rows += result["rows"]
+                print(f"  chunk {chunk['chunk']} (ids from {chunk['from_id']}): "
+                      f"{result['rows']} row(s) in {len(result['files'])} file(s)")
+        if failed:
+            raise RuntimeError(f"{failed} chunk(s) failed; rerun to resume")
+        elapsed = time.monotonic() - started
+        print(f"✅ Export complete: {rows} row(s) in {elapsed:.1f}s, manifest {manifest_path}")
+    except Exception as e:
+        print("❌ Export failed:", str(e))
+        raise
 
 if __name__ == "__main__":
-    sync_to_redshift()
+    try:
+        if len(sys.argv) == 3 and sys.argv[1] == "export":
+            export_full(sys.argv[2])
+        else:
+            sync_to_redshift()
+    except Exception:
+        sys.exit(1)
@@ -0,0 +1,31 @@
+-- Tables the publisher loads into, for the local Postgres stand-in
+-- (SYNC_TARGET=postgres). On Redshift the JSON columns (details, products,
+-- additional_details, report_data) are SUPER: reports outgrow VARCHAR's
+-- 64KB limit. sync_watermarks is created by the publisher itself.
+
+CREATE TABLE IF NOT EXISTS agents (
+    id INTEGER NOT NULL,
+    name VARCHAR(256),
+    code VARCHAR(64),
+    details TEXT,
+    products TEXT,
+    branch_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS sales_data (
+    id INTEGER NOT NULL,
+    agent_id INTEGER,
+    sale_amount NUMERIC(12, 2),
+    product_code VARCHAR(64),
+    sale_date TIMESTAMP,
+    additional_details TEXT,
+    created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS performance_reports (
+    id INTEGER NOT NULL,
+    report_date DATE,
+    frequency VARCHAR(32),
+    report_data TEXT,
+    created_at TIMESTAMP
+);